@@ -0,0 +1,311 @@
+import sys
+import os
+import json
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+import timeit
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+import h5py
+import numpy
+from trainpredict import TrainPredictData
+
+
+def parse_args():
+    """Parse the command line arguments.
+
+    :return: parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the load paths of TrainPredictData on synthetic data.")
+    parser.add_argument("--instances", type=int, default=100000, help="number of instances")
+    parser.add_argument("--features", type=int, default=64, help="total number of features")
+    parser.add_argument("--feature-files", type=int, default=16, help="number of feature files")
+    parser.add_argument("--dtype", default="float32", help="dtype of the stored features")
+    parser.add_argument("--chunks", type=int, default=0, help="instances per chunk (0: contiguous)")
+    parser.add_argument("--compression", default="none", choices=["none", "gzip", "lzf"],
+                        help="compression of the stored data")
+    parser.add_argument("--repeat", type=int, default=3, help="number of repetitions of each benchmark")
+    parser.add_argument("--workers", type=int, default=4, help="number of workers for the parallel benchmark")
+    parser.add_argument("--max-open-files", type=int, default=16,
+                        help="max_open_files of the benchmarked TrainPredictData instances")
+    parser.add_argument("--workdir", default=None, help="directory for the synthetic data (default: temporary)")
+    parser.add_argument("--output", default=None, help="write the results as json to this file (default: stdout)")
+    parser.add_argument("--baseline", default=None, help="compare the results against this json file")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="relative slowdown that is reported as regression")
+    return parser.parse_args()
+
+
+def create_dataset(f, key, data, args):
+    """Create a data set with the chunking and compression of the arguments.
+
+    :param f: open h5py file
+    :param key: h5 key
+    :param data: numpy array
+    :param args: parsed arguments
+    """
+    kwargs = {}
+    if args.chunks > 0:
+        kwargs["chunks"] = (min(args.chunks, data.shape[0]),) + data.shape[1:]
+    if args.compression != "none":
+        kwargs["compression"] = args.compression
+    f.create_dataset(key, data=data, **kwargs)
+
+
+def create_data(workdir, args):
+    """Write synthetic raw, gt and feature files into the given directory.
+
+    :param workdir: output directory
+    :param args: parsed arguments
+    :return: raw file, gt file, list with (feature file, h5 key)
+    """
+    rng = numpy.random.RandomState(0)
+    n = args.instances
+    raw_file = os.path.join(workdir, "raw.h5")
+    with h5py.File(raw_file, "w") as f:
+        create_dataset(f, "raw", rng.rand(n).astype(args.dtype), args)
+    gt_file = os.path.join(workdir, "gt.h5")
+    with h5py.File(gt_file, "w") as f:
+        create_dataset(f, "gt", rng.randint(0, 4, n).astype(numpy.uint8), args)
+
+    features = []
+    num_files = max(1, min(args.feature_files, args.features))
+    for i in xrange(num_files):
+        num_feats = args.features // num_files + (1 if i < args.features % num_files else 0)
+        feat_file = os.path.join(workdir, "feat_%d.h5" % i)
+        with h5py.File(feat_file, "w") as f:
+            create_dataset(f, "feat", rng.rand(n, num_feats).astype(args.dtype), args)
+        features.append((feat_file, "feat"))
+    return raw_file, gt_file, features
+
+
+def count_open_fds():
+    """Return the number of open file descriptors of this process (None if unknown).
+
+    :return: number of open file descriptors
+    """
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+def count_open_files():
+    """Return the numbers of open h5py files and file descriptors of this process.
+
+    :return: dict with the open file counts
+    """
+    return {"open_h5_files": h5py.h5f.get_obj_count(h5py.h5f.OBJ_ALL, h5py.h5f.OBJ_FILE),
+            "open_fds": count_open_fds()}
+
+
+def peak_rss_mb():
+    """Return the peak resident set size of this process in MB.
+
+    :return: peak RSS
+    """
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return rss / 2.0**20
+    return rss / 2.0**10
+
+
+def measure(queue, func, repeat):
+    """
+    Run func repeat times and put the best time, the number of read bytes, the
+    increase of the peak RSS and the open file counts into the queue. The open
+    file counts are sampled by func while the TrainPredictData is still open.
+
+    :param queue: multiprocessing queue for the result
+    :param func: function that returns the number of read bytes and the open file counts
+    :param repeat: number of repetitions
+    """
+    try:
+        start_rss = peak_rss_mb()
+        times = []
+        nbytes = 0
+        counts = {}
+        for _ in xrange(repeat):
+            t = timeit.default_timer()
+            nbytes, counts = func()
+            times.append(timeit.default_timer() - t)
+        seconds = min(times)
+        result = {"seconds": seconds,
+                  "bytes": nbytes,
+                  "mb_per_s": nbytes / 2.0**20 / seconds if nbytes and seconds > 0 else None,
+                  "peak_rss_mb": peak_rss_mb() - start_rss}
+        result.update(counts)
+    except Exception as e:
+        result = {"error": repr(e)}
+    queue.put(result)
+
+
+def run_isolated(func, repeat):
+    """Run the measurement in a separate process, so the peak RSS of each benchmark is separated.
+
+    :param func: function that returns the number of read bytes and the open file counts
+    :param repeat: number of repetitions
+    :return: dict with the measurements
+    """
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=measure, args=(queue, func, repeat))
+    p.start()
+    # Poll the queue, so a process that dies without a result (e.g. killed by
+    # the OOM killer) does not block forever.
+    while True:
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Queue.Empty:
+            if not p.is_alive():
+                try:
+                    result = queue.get(timeout=1)
+                except Queue.Empty:
+                    result = {"error": "benchmark process died with exit code %s" % p.exitcode}
+                break
+    p.join()
+    return result
+
+
+def run_benchmarks(workdir, args):
+    """Create the synthetic data and run all benchmarks.
+
+    :param workdir: directory for the synthetic data
+    :param args: parsed arguments
+    :return: dict with the results
+    """
+    raw_file, gt_file, features = create_data(workdir, args)
+    tpd_file = os.path.join(workdir, "bench.tpd")
+    tpd = TrainPredictData(tpd_file)
+    tpd.set_train_raw(raw_file, "raw")
+    tpd.set_train_gt(gt_file, "gt")
+    tpd.add_train_features(features)
+    tpd.close()
+
+    # The open file counts are sampled before the files are closed at the end
+    # of the with blocks.
+    def open_tpd(file_name):
+        return TrainPredictData(file_name, max_open_files=args.max_open_files)
+
+    def add_features_single():
+        with open_tpd(os.path.join(workdir, "add_single.tpd")) as t:
+            t.clear_train_features()
+            for feat_file, h5_key in features:
+                t.add_train_feature(feat_file, h5_key)
+            return 0, count_open_files()
+
+    def add_features_bulk():
+        with open_tpd(os.path.join(workdir, "add_bulk.tpd")) as t:
+            t.clear_train_features()
+            t.add_train_features(features)
+            return 0, count_open_files()
+
+    def manifest_getters():
+        with open_tpd(tpd_file) as t:
+            for _ in xrange(100):
+                t.get_train_raw()
+                t.get_train_gt()
+                for i in xrange(len(features)):
+                    t.get_train_feature_file(i)
+            return 0, count_open_files()
+
+    def get_raw_data():
+        with open_tpd(tpd_file) as t:
+            return t.get_train_raw_data().nbytes, count_open_files()
+
+    def get_gt_data():
+        with open_tpd(tpd_file) as t:
+            return t.get_train_gt_data().nbytes, count_open_files()
+
+    def get_features(dtype, workers):
+        def func():
+            with open_tpd(tpd_file) as t:
+                return t.get_train_features(dtype=dtype, workers=workers).nbytes, count_open_files()
+        return func
+
+    benchmarks = [("add_train_feature", add_features_single),
+                  ("add_train_features", add_features_bulk),
+                  ("manifest_getters", manifest_getters),
+                  ("get_train_raw_data", get_raw_data),
+                  ("get_train_gt_data", get_gt_data),
+                  ("get_train_features_float64", get_features(numpy.float64, 1)),
+                  ("get_train_features_float32", get_features(numpy.float32, 1)),
+                  ("get_train_features_workers", get_features(numpy.float64, args.workers))]
+    results = {}
+    for name, func in benchmarks:
+        results[name] = run_isolated(func, args.repeat)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Compare the results against a baseline.
+
+    :param results: dict with the results
+    :param baseline: dict with the baseline results
+    :param tolerance: relative slowdown that is reported as regression
+    :return: dict with the comparison, True if there is a regression
+    """
+    comparison = {}
+    regression = False
+    for name, result in results.items():
+        if name not in baseline or "seconds" not in result or "seconds" not in baseline[name]:
+            continue
+        ratio = result["seconds"] / baseline[name]["seconds"] if baseline[name]["seconds"] > 0 else None
+        is_regression = ratio is not None and ratio > 1 + tolerance
+        regression = regression or is_regression
+        comparison[name] = {"baseline_seconds": baseline[name]["seconds"],
+                            "seconds": result["seconds"],
+                            "ratio": ratio,
+                            "regression": is_regression}
+    return comparison, regression
+
+
+def main():
+    """Run the benchmarks and write the results as json.
+    """
+    args = parse_args()
+    workdir = args.workdir
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix="tpd_bench_")
+    elif not os.path.isdir(workdir):
+        os.makedirs(workdir)
+
+    try:
+        results = run_benchmarks(workdir, args)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+
+    report = {"config": {"instances": args.instances,
+                         "features": args.features,
+                         "feature_files": args.feature_files,
+                         "dtype": args.dtype,
+                         "chunks": args.chunks,
+                         "compression": args.compression,
+                         "repeat": args.repeat,
+                         "workers": args.workers,
+                         "max_open_files": args.max_open_files},
+              "results": results}
+    regression = False
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        report["comparison"], regression = compare(results, baseline["results"], args.tolerance)
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return 1 if regression else 0
+
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
@@ -0,0 +1,204 @@
+import sys
+import os
+import shutil
+import argparse
+import multiprocessing
+import h5py
+from trainpredict import TrainPredictData, TPDError
+
+
+# Target size of a chunk in bytes.
+CHUNK_BYTES = 2**20
+
+# Number of bytes that are copied at once.
+COPY_BYTES = 2**26
+
+
+def parse_args():
+    """Parse the command line arguments.
+
+    :return: parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Rewrite the data sets of a .tpd file with chunks and compression "
+                                                 "that fit the given access profile and update the .tpd file.")
+    parser.add_argument("tpd_file", help="the .tpd file")
+    parser.add_argument("--profile", default="rows", choices=["rows", "columns", "blocks"],
+                        help="access profile: batches of instances, full feature columns or 3D blocks")
+    parser.add_argument("--outdir", default=None,
+                        help="directory for the repacked files (default: repacked/ next to the .tpd file)")
+    parser.add_argument("--compression", default="lzf", choices=["none", "gzip", "lzf"],
+                        help="compression of the repacked data sets")
+    parser.add_argument("--level", type=int, default=1, help="gzip compression level")
+    parser.add_argument("--block-size", type=int, default=64, help="edge length of the chunks for the blocks profile")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="number of files that are repacked in parallel")
+    parser.add_argument("--abs-paths", action="store_true", help="store absolute paths in the .tpd file")
+    return parser.parse_args()
+
+
+def get_chunks(shape, itemsize, num_feats, profile, block_size):
+    """Return the chunk shape of a data set for the given access profile.
+
+    :param shape: shape of the data set
+    :param itemsize: size of a single element in bytes
+    :param num_feats: number of features in the data set (1 for raw, gt and pred data)
+    :param profile: access profile ("rows", "columns" or "blocks")
+    :param block_size: edge length of the chunks for the blocks profile
+    :return: chunk shape (None for empty and scalar data sets)
+    """
+    if len(shape) == 0 or TrainPredictData._get_count(shape) == 0:
+        return None
+    if profile == "blocks" and len(shape) >= 3:
+        return tuple(min(s, block_size) for s in shape)
+    if profile == "columns" and num_feats > 1:
+        rows = max(1, CHUNK_BYTES // itemsize)
+        return (min(shape[0], rows),) + (1,) * (len(shape)-1)
+    rows = max(1, CHUNK_BYTES // (itemsize * TrainPredictData._get_count(shape[1:])))
+    return (min(shape[0], rows),) + tuple(shape[1:])
+
+
+def repack_file(args):
+    """Copy the given data sets of a file into a new file with new chunks and compression.
+
+    :param args: source file, target file, list with (h5 key, chunks), compression, compression level
+    :return: target file
+    """
+    src_file, dst_file, keys, compression, level = args
+    kwargs = {}
+    if compression != "none":
+        kwargs["compression"] = compression
+        kwargs["shuffle"] = True
+        if compression == "gzip":
+            kwargs["compression_opts"] = level
+    tmp_file = dst_file + ".tmp"
+    with h5py.File(src_file, "r") as src, h5py.File(tmp_file, "w") as dst:
+        for h5_key, chunks in keys:
+            dset = src[h5_key]
+            if chunks is None:
+                out = dst.create_dataset(h5_key, data=dset[()])
+            else:
+                # The data sets are resizable, so instances can be appended.
+                out = dst.create_dataset(h5_key, shape=dset.shape, dtype=dset.dtype, chunks=chunks,
+                                         maxshape=(None,) + dset.shape[1:], **kwargs)
+            # Keep the attributes, e.g. scale and offset of quantized features.
+            for name, value in dset.attrs.items():
+                out.attrs[name] = value
+            if chunks is None:
+                continue
+            # Copy slabs that consist of whole chunks along the first axis.
+            slab_bytes = TrainPredictData._get_count(dset.shape[1:]) * dset.dtype.itemsize * chunks[0]
+            step = chunks[0] * max(1, COPY_BYTES // max(slab_bytes, 1))
+            for start in xrange(0, dset.shape[0], step):
+                out[start:start+step] = dset[start:start+step]
+    os.rename(tmp_file, dst_file)
+    return dst_file
+
+
+def collect_data_sets(tpd):
+    """Return the data sets that are referenced in the .tpd file.
+
+    :param tpd: TrainPredictData
+    :return: list with (setter name, file name, h5 key), training features, test features, dict with the
+             numbers of instances of the features
+    """
+    data_sets = []
+    for name in ["train_raw", "train_gt", "train_pred", "test_raw", "test_gt", "test_pred"]:
+        try:
+            file_name, h5_key = getattr(tpd, "get_" + name)()
+        except TPDError:
+            continue
+        data_sets.append(("set_" + name, file_name, h5_key))
+
+    def get_features(get_file):
+        features = []
+        while True:
+            try:
+                features.append(get_file(len(features)))
+            except TPDError:
+                return features
+
+    train_features = get_features(tpd.get_train_feature_file)
+    test_features = get_features(tpd.get_test_feature_file)
+    counts = {}
+    for features, matrix in [(train_features, tpd.train_features), (test_features, tpd.test_features)]:
+        if len(features) > 0:
+            for file_name, h5_key in features:
+                counts[(os.path.realpath(file_name), h5_key)] = matrix.shape[0]
+    return data_sets, train_features, test_features, counts
+
+
+def main():
+    """Repack the data sets of a .tpd file and update the .tpd file.
+    """
+    args = parse_args()
+    tpd = TrainPredictData(args.tpd_file)
+    data_sets, train_features, test_features, counts = collect_data_sets(tpd)
+    tpd.close()
+
+    outdir = args.outdir
+    if outdir is None:
+        outdir = os.path.join(os.path.dirname(args.tpd_file), "repacked")
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    # Group the data sets by file, so each file is repacked by a single worker.
+    files = {}
+    targets = {}
+    for file_name, h5_key in [(d[1], d[2]) for d in data_sets] + train_features + test_features:
+        path = os.path.realpath(file_name)
+        if path not in targets:
+            base = os.path.basename(path)
+            target = os.path.join(outdir, base)
+            i = 1
+            while target in targets.values():
+                target = os.path.join(outdir, "%s_%d%s" % (os.path.splitext(base)[0], i, os.path.splitext(base)[1]))
+                i += 1
+            targets[path] = target
+            files[path] = []
+        if h5_key not in [k for k, _ in files[path]]:
+            with h5py.File(path, "r") as f:
+                dset = f[h5_key]
+                shape, itemsize = dset.shape, dset.dtype.itemsize
+            # Data sets with a single feature per instance (e.g. volumes) are read as a whole.
+            num_feats = 1
+            if (path, h5_key) in counts and TrainPredictData._get_count(shape) != counts[(path, h5_key)]:
+                num_feats = TrainPredictData._get_count(shape[1:])
+            files[path].append((h5_key, get_chunks(shape, itemsize, num_feats, args.profile, args.block_size)))
+
+    # Repack the files in parallel.
+    jobs = [(path, targets[path], keys, args.compression, args.level) for path, keys in files.items()]
+    pool = multiprocessing.Pool(max(1, min(args.workers, len(jobs))))
+    try:
+        for dst_file in pool.imap_unordered(repack_file, jobs):
+            print("Repacked %s" % dst_file)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Update a copy of the .tpd file and replace the original in one step.
+    tmp_tpd_file = args.tpd_file + ".tmp"
+    shutil.copy2(args.tpd_file, tmp_tpd_file)
+    try:
+        with TrainPredictData(tmp_tpd_file, use_abs_paths=args.abs_paths) as tpd:
+            with tpd.batch():
+                for setter, file_name, h5_key in data_sets:
+                    getattr(tpd, setter)(targets[os.path.realpath(file_name)], h5_key)
+                if len(train_features) > 0:
+                    tpd.clear_train_features()
+                    tpd.add_train_features([(targets[os.path.realpath(file_name)], h5_key)
+                                            for file_name, h5_key in train_features])
+                if len(test_features) > 0:
+                    tpd.clear_test_features()
+                    tpd.add_test_features([(targets[os.path.realpath(file_name)], h5_key)
+                                           for file_name, h5_key in test_features])
+        os.rename(tmp_tpd_file, args.tpd_file)
+    except:
+        os.remove(tmp_tpd_file)
+        raise
+    print("Updated %s" % args.tpd_file)
+    return 0
+
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
@@ -1,13 +1,428 @@
 import os
-import h5py
-import vigra
+import json
+import hashlib
+import threading
+import collections
+import contextlib
+import functools
+import itertools
+import timeit
+import weakref
 import numpy
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 
 class TPDError(RuntimeError):
     pass
 
 
+def _get_file_stat(file_name):
+    """Return modification time and size of the given file.
+
+    :param file_name: file name
+    :return: modification time, size
+    """
+    st = os.stat(file_name)
+    return st.st_mtime, st.st_size
+
+
+class TPDStats(object):
+    """
+    Collects wall time, read and written bytes, number of file opens and the
+    touched files of the instrumented TrainPredictData calls.
+
+    The totals of each instrumented method are stored in totals. If a callback
+    is given, it is called with a dict that describes each finished call.
+    """
+
+    def __init__(self, callback=None):
+        """Create an empty statistics object.
+
+        :param callback: function that is called with the record of each finished call
+        """
+        self.callback = callback
+        self.totals = {}
+        self._local = threading.local()
+        self._blocks = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _new_record(name):
+        """Return an empty record.
+
+        :param name: name of the call or block
+        :return: record
+        """
+        return {"name": name, "calls": 0, "seconds": 0.0, "bytes_read": 0, "bytes_written": 0,
+                "file_opens": 0, "files": set()}
+
+    def _get_active(self):
+        """Return the stack with the records of the running calls of the current thread.
+
+        :return: list with records
+        """
+        if not hasattr(self._local, "active"):
+            self._local.active = []
+        return self._local.active
+
+    def begin(self, name):
+        """Start the record of a call.
+
+        :param name: name of the call
+        :return: record
+        """
+        record = self._new_record(name)
+        record["calls"] = 1
+        record["start"] = timeit.default_timer()
+        self._get_active().append(record)
+        return record
+
+    def end(self, record):
+        """Finish the record of a call, add it to the totals and pass it to the callback.
+
+        :param record: record that was returned by begin()
+        """
+        record["seconds"] = timeit.default_timer() - record.pop("start")
+        self._get_active().remove(record)
+        with self._lock:
+            total = self.totals.setdefault(record["name"], self._new_record(record["name"]))
+            for key in ("calls", "seconds", "bytes_read", "bytes_written", "file_opens"):
+                total[key] += record[key]
+            total["files"].update(record["files"])
+            for block in self._blocks:
+                block["calls"] += 1
+        if self.callback is not None:
+            self.callback(record)
+
+    def record_io(self, file_name=None, bytes_read=0, bytes_written=0, file_opens=0):
+        """Add I/O to the running calls of the current thread and to the active blocks.
+
+        :param file_name: name of the touched file
+        :param bytes_read: number of read bytes
+        :param bytes_written: number of written bytes
+        :param file_opens: number of file opens
+        """
+        with self._lock:
+            for record in self._get_active() + self._blocks:
+                record["bytes_read"] += bytes_read
+                record["bytes_written"] += bytes_written
+                record["file_opens"] += file_opens
+                if file_name is not None:
+                    record["files"].add(os.path.abspath(file_name))
+
+    @contextlib.contextmanager
+    def block(self, name="block"):
+        """
+        Context manager that yields a record with the totals of all calls and
+        I/O while the block is active.
+
+        :param name: name of the block
+        """
+        record = self._new_record(name)
+        start = timeit.default_timer()
+        with self._lock:
+            self._blocks.append(record)
+        try:
+            yield record
+        finally:
+            with self._lock:
+                self._blocks.remove(record)
+            record["seconds"] = timeit.default_timer() - start
+
+    def reset(self):
+        """Clear the totals.
+        """
+        with self._lock:
+            self.totals = {}
+
+
+class Block(collections.namedtuple("Block", ["begin", "end", "outer_begin", "outer_end", "data"])):
+    """
+    Block of a data set. begin and end are the global coordinates of the block,
+    outer_begin and outer_end include the halo. data contains the block with
+    the halo.
+    """
+    __slots__ = ()
+
+    @property
+    def inner(self):
+        """Return the slicing that removes the halo from data.
+        """
+        return tuple(slice(b - ob, e - ob) for b, e, ob in zip(self.begin, self.end, self.outer_begin))
+
+
+def _prefetch(iterable, size):
+    """
+    Iterate over iterable in a background thread that keeps up to size items
+    ready. Exceptions of the background thread are raised in the caller.
+
+    :param iterable: iterable
+    :param size: number of prefetched items (0: no background thread)
+    :return: generator with the items of iterable
+    """
+    if size <= 0:
+        for item in iterable:
+            yield item
+        return
+
+    items = queue.Queue(size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((done, e))
+
+    thread = threading.Thread(target=worker)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _instrumented(func):
+    """Decorator that records the calls of a TrainPredictData method if statistics are enabled.
+
+    :param func: method
+    :return: instrumented method
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if self.stats is None:
+            return func(self, *args, **kwargs)
+        record = self.stats.begin(func.__name__)
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self.stats.end(record)
+    return wrapper
+
+
+class _FilePool(object):
+    """
+    Least recently used pool of open read-only h5py files.
+
+    Files that are currently in use are never closed, so the number of open
+    files may temporarily exceed the maximum. A file is reopened if its
+    modification time or size changed since it was opened.
+    """
+
+    def __init__(self, max_open_files, on_open=None, swmr=False):
+        """Create an empty pool.
+
+        :param max_open_files: maximum number of unused open files
+        :param on_open: function that is called with the file name whenever a file is opened
+        :param swmr: open the files as SWMR readers
+        """
+        self.max_open_files = max_open_files
+        self.on_open = on_open
+        self.swmr = swmr
+        self._files = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self):
+        """Close the least recently used unused files until the maximum is reached.
+        """
+        for path in list(self._files.keys()):
+            if len(self._files) <= self.max_open_files:
+                break
+            entry = self._files[path]
+            if entry["users"] == 0:
+                entry["file"].close()
+                del self._files[path]
+
+    def acquire(self, file_name):
+        """Return the open file with the given name and mark it as used.
+
+        :param file_name: file name
+        :return: h5py file
+        """
+        import h5py
+        path = os.path.realpath(file_name)
+        stat = _get_file_stat(path)
+        with self._lock:
+            entry = self._files.pop(path, None)
+            if entry is not None and entry["users"] == 0 and entry["stat"] != stat:
+                entry["file"].close()
+                entry = None
+            if entry is None:
+                if self.swmr:
+                    f = h5py.File(path, "r", libver="latest", swmr=True)
+                else:
+                    f = h5py.File(path, "r")
+                entry = {"file": f, "stat": stat, "users": 0}
+                if self.on_open is not None:
+                    self.on_open(file_name)
+            entry["users"] += 1
+            self._files[path] = entry
+            self._evict()
+            return entry["file"]
+
+    def release(self, file_name):
+        """Mark the file with the given name as unused.
+
+        :param file_name: file name
+        """
+        path = os.path.realpath(file_name)
+        with self._lock:
+            self._files[path]["users"] -= 1
+            self._evict()
+
+    @contextlib.contextmanager
+    def open(self, file_name, keep=True):
+        """Context manager that acquires and releases the file with the given name.
+
+        :param file_name: file name
+        :param keep: if False, the file is closed afterwards (unless it is used elsewhere)
+        """
+        f = self.acquire(file_name)
+        try:
+            yield f
+        finally:
+            self.release(file_name)
+            if not keep:
+                self.discard(file_name)
+
+    def discard(self, file_name):
+        """Close the file with the given name, so it can be opened for writing.
+
+        :param file_name: file name
+        """
+        path = os.path.realpath(file_name)
+        with self._lock:
+            entry = self._files.get(path, None)
+            if entry is not None and entry["users"] == 0:
+                entry["file"].close()
+                del self._files[path]
+
+    def close(self):
+        """Close all unused files.
+        """
+        with self._lock:
+            for path in list(self._files.keys()):
+                if self._files[path]["users"] == 0:
+                    self._files[path]["file"].close()
+                    del self._files[path]
+
+
+# The shared output array of the feature reading worker processes and
+# whether the workers open the files as SWMR readers.
+_worker_feats = None
+_worker_swmr = False
+
+
+def _init_feature_worker(buf, shape, dtype, swmr=False):
+    """Initialize a feature reading worker process with the shared output array.
+
+    :param buf: shared memory buffer
+    :param shape: shape of the output array
+    :param dtype: dtype of the output array
+    :param swmr: open the files as SWMR readers
+    """
+    global _worker_feats, _worker_swmr
+    _worker_feats = numpy.frombuffer(buf, dtype=dtype, count=int(TrainPredictData._get_count(shape))).reshape(shape)
+    _worker_swmr = swmr
+
+
+def _read_feature_worker(args):
+    """Read a single feature file into its columns of the shared output array.
+
+    :param args: file name, h5 key, index of the first column, number of features, selected rows, selected columns
+    :return: file name, number of read bytes
+    """
+    import h5py
+    file_path, h5_key, current_feat, num_feats, rows, columns = args
+    kwargs = {"libver": "latest", "swmr": True} if _worker_swmr else {}
+    with h5py.File(file_path, "r", **kwargs) as f:
+        return file_path, TrainPredictData._read_feature_into(f[h5_key], _worker_feats, current_feat, num_feats,
+                                                              rows, columns)
+
+
+class FeatureMatrix(object):
+    """
+    Lazy (n, d) array-like view of the training or test features of a
+    TrainPredictData. Indexing only reads the selected instances and features
+    from the feature files, numpy.asarray() reads the whole matrix.
+    """
+
+    def __init__(self, tpd, tpd_key, tpd_shape, dtype=numpy.float64):
+        """Create the view.
+
+        :param tpd: TrainPredictData instance
+        :param tpd_key: tpd key of the feature list
+        :param tpd_shape: tpd key of the shape of the raw data
+        :param dtype: dtype of the returned features
+        """
+        self._tpd = tpd
+        self._tpd_key = tpd_key
+        self._tpd_shape = tpd_shape
+        self.dtype = numpy.dtype(dtype)
+
+    @property
+    def shape(self):
+        """Return the shape (n, d) of the feature matrix.
+        """
+        _, count, num_all_feats, _ = self._tpd._get_feature_layout(self._tpd_key, self._tpd_shape)
+        return int(count), int(sum(num_all_feats))
+
+    @property
+    def ndim(self):
+        return 2
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        """Read the selected instances and features.
+
+        :param key: row index or (row index, feature index), each an int, slice, index array or boolean mask
+        :return: numpy array with the selected features
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 2:
+            raise IndexError("FeatureMatrix.__getitem__(): Too many indices.")
+        key = [slice(None) if k is Ellipsis else k for k in key] + [slice(None)] * (2 - len(key))
+        squeeze = tuple(i for i in xrange(2) if numpy.ndim(key[i]) == 0 and not isinstance(key[i], slice))
+        rows, features = [None if isinstance(k, slice) and k == slice(None) else k for k in key]
+        feats = self._tpd._get_feature_data(self._tpd_key, self._tpd_shape, self.dtype, rows=rows, features=features)
+        if len(squeeze) > 0:
+            feats = feats.squeeze(axis=squeeze)
+        return feats
+
+    def __array__(self, dtype=None, copy=None):
+        feats = self._tpd._get_feature_data(self._tpd_key, self._tpd_shape, self.dtype)
+        if dtype is not None:
+            feats = feats.astype(dtype, copy=False)
+        return feats
+
+
 class TrainPredictData(object):
     """
     The TrainPredictData class can be used to store and load .tpd files (data
@@ -32,6 +447,27 @@ class TrainPredictData(object):
     _tpd_test_pred_path = "test_pred_path"
     _tpd_test_pred_key = "test_pred_key"
 
+    # Index arrays with more contiguous runs are not read as hyperslab unions.
+    _max_hyperslab_runs = 256
+
+    # Such index arrays are read as point selections if they select less than
+    # this fraction of the chunks that contain them. Else, the containing
+    # chunks are read as hyperslabs (at most _max_covering_bytes at once) and
+    # the selected instances are taken from them in memory.
+    _point_selection_density = 1.0 / 64
+    _max_covering_bytes = 2**26
+
+    # The key with the info about the features (shape, dtype, chunks, ...) is
+    # the key of the feature list with this suffix.
+    _tpd_info_suffix = "_info"
+
+    # The group with the feature statistics is the key of the feature list with
+    # this suffix.
+    _tpd_stats_suffix = "_stats"
+
+    # The group with the label index is the key of the gt data with this suffix.
+    _tpd_index_suffix = "_index"
+
     @staticmethod
     def _check_file_exists(file_name):
         """Raise an exception if the given file does not exist.
@@ -52,27 +488,270 @@ class TrainPredictData(object):
         from operator import mul
         return reduce(mul, shape, 1)
 
-    def __init__(self, file_name, use_abs_paths=False):
+    def __init__(self, file_name, use_abs_paths=False, max_open_files=0, stats=None, swmr=False, lazy=False,
+                 use_vigra=True):
         """
         Create a TrainPredictData instance by loading the given file.
         If the given file does not exist, it will be created.
 
+        If lazy is True, the file is only created and loaded with the first
+        call that needs its content.
+
+        If max_open_files > 0, up to max_open_files referenced data files are
+        kept open (read-only) in a pool, until close() is called or the
+        instance is used as context manager. While a file is in the pool, it
+        cannot be opened for writing in the same process. Files that are only
+        registered by the set_* and add_* methods are never kept open.
+
         :param file_name: file name
         :param use_abs_paths: when adding new data sets, the absolute path will be used instead of the relative path
+        :param max_open_files: maximum number of unused data files that are kept open (0: close after use)
+        :param stats: TPDStats object that records the I/O of this instance
+        :param swmr: single writer / multiple reader mode: the data files are opened as SWMR readers,
+                     the .tpd file is changed on a copy that replaces it atomically and predictions
+                     are written in SWMR mode
+        :param lazy: defer all file access until the content of the .tpd file is needed
+        :param use_vigra: read whole data sets with vigra (if vigra is available), else with h5py (the
+                          data is transposed, so it has the same axis order as with vigra)
         """
         self.file_name = file_name
         self.use_abs_paths = use_abs_paths
+        self.stats = stats
+        self.swmr = swmr
+        self.use_vigra = use_vigra
+        # The pool only holds a weak reference, so the instance is closed when it is deleted.
+        self_ref = weakref.ref(self)
+
+        def on_open(name):
+            tpd = self_ref()
+            if tpd is not None:
+                tpd._record_io(name, file_opens=1)
+
+        self._files = _FilePool(max_open_files, on_open=on_open, swmr=swmr)
         dirname = os.path.dirname(self.file_name)
         if len(dirname) == 0:
             dirname = "."
-        if not os.path.isdir(dirname):
-            os.makedirs(dirname)
+        self._dirname = dirname
         self.base_path = os.path.relpath(dirname)
 
-        # Check if the file can be opened with h5py.
-        # If it does not exist, it will be created by h5py.
-        f = h5py.File(file_name, "a")
-        f.close()
+        # The content of the .tpd file is cached in memory and reloaded when
+        # the modification time or the size of the file changes.
+        self._manifest = None
+        self._manifest_stat = None
+
+        # Inside batch(), the changes are collected and written at the end.
+        self._batch_depth = 0
+        self._pending = {}
+
+        # The stats and label index groups that could not be written to the
+        # .tpd file. In SWMR mode, they are always kept here, so readers never
+        # write the .tpd file.
+        self._groups = {}
+
+        self._created = False
+        if not lazy:
+            self._get_manifest()
+
+    def _create(self):
+        """Create the directory and the .tpd file, if they do not exist. The
+        file is then loaded to check that it can be opened with h5py.
+        """
+        import h5py
+        if not os.path.isdir(self._dirname):
+            os.makedirs(self._dirname)
+        if not os.path.isfile(self.file_name):
+            f = h5py.File(self.file_name, "a")
+            f.close()
+        self._created = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        files = getattr(self, "_files", None)
+        if files is not None:
+            files.close()
+
+    def close(self):
+        """Close all data files that are kept open.
+        """
+        self._files.close()
+
+    def _record_io(self, file_name=None, bytes_read=0, bytes_written=0, file_opens=0):
+        """Pass the given I/O to the statistics object (if statistics are enabled).
+
+        :param file_name: name of the touched file
+        :param bytes_read: number of read bytes
+        :param bytes_written: number of written bytes
+        :param file_opens: number of file opens
+        """
+        if self.stats is not None:
+            self.stats.record_io(file_name, bytes_read, bytes_written, file_opens)
+
+    def _get_tpd_stat(self):
+        """Return modification time and size of the .tpd file.
+
+        :return: modification time, size
+        """
+        return _get_file_stat(self.file_name)
+
+    def _get_manifest(self):
+        """
+        Return a dict with the content of the .tpd file. The file is only read
+        again if its modification time or size changed since the last read.
+
+        :return: dict with the tpd keys and their values
+        """
+        if self._batch_depth > 0:
+            return self._manifest
+        if not self._created:
+            self._create()
+        stat = self._get_tpd_stat()
+        if self._manifest is None or stat != self._manifest_stat:
+            self._load_manifest(stat)
+        return self._manifest
+
+    @_instrumented
+    def _load_manifest(self, stat):
+        """Read the content of the .tpd file into the cached manifest.
+
+        :param stat: modification time and size of the .tpd file
+        """
+        import h5py
+        manifest = {}
+        with h5py.File(self.file_name, "r") as f:
+            self._record_io(self.file_name, file_opens=1)
+            for key in f.keys():
+                if isinstance(f[key], h5py.Dataset):
+                    manifest[key] = f[key].value
+                    self._record_io(bytes_read=f[key].id.get_storage_size())
+        self._manifest = manifest
+        self._manifest_stat = stat
+
+    def _write_manifest(self, values):
+        """Write the given values to the .tpd file and to the cached manifest.
+
+        Inside batch(), only the cached manifest is changed and the values are
+        written to the file when the batch ends.
+
+        :param values: dict with tpd keys and the new values (None removes the key)
+        """
+        manifest = self._get_manifest()
+        if self._batch_depth > 0:
+            for key, value in values.items():
+                manifest.pop(key, None)
+                if value is not None:
+                    manifest[key] = value
+            self._pending.update(values)
+            return
+
+        with self._open_tpd() as f:
+            for key, value in values.items():
+                manifest.pop(key, None)
+                if value is None:
+                    if key in f.keys():
+                        del f[key]
+                elif isinstance(value, numpy.ndarray) and value.ndim > 0 and value.dtype.kind in "SUO":
+                    self._write_list(f, key, value)
+                    manifest[key] = f[key].value
+                    self._record_io(bytes_written=f[key].id.get_storage_size())
+                else:
+                    if key in f.keys():
+                        del f[key]
+                    f[key] = value
+                    manifest[key] = f[key].value
+                    self._record_io(bytes_written=f[key].id.get_storage_size())
+        self._manifest_stat = self._get_tpd_stat()
+
+    @staticmethod
+    def _write_list(f, key, value):
+        """
+        Write an array of strings (e.g. a feature list) to a resizable data set.
+        If the stored list is a prefix of the new list, only the new entries are
+        appended. Otherwise the data set is replaced.
+
+        :param f: open .tpd file
+        :param key: tpd key
+        :param value: numpy array with strings
+        """
+        import h5py
+        value = value.astype(object)
+        if key in f.keys():
+            dset = f[key]
+            old_len = dset.shape[0]
+            if dset.maxshape[0] is None and dset.shape[1:] == value.shape[1:] and old_len <= len(value) and \
+                    dset.value.tolist() == value[:old_len].tolist():
+                if old_len < len(value):
+                    dset.resize(len(value), axis=0)
+                    dset[old_len:] = value[old_len:]
+                return
+            del f[key]
+        f.create_dataset(key, data=value, dtype=h5py.special_dtype(vlen=str),
+                         maxshape=(None,) + value.shape[1:], chunks=(64,) + value.shape[1:])
+
+    @contextlib.contextmanager
+    def _open_tpd(self):
+        """
+        Context manager that opens the .tpd file for writing. In SWMR mode, a
+        copy of the .tpd file is changed and then renamed to the .tpd file, so
+        readers never see a partially written file and are never locked out.
+        """
+        import h5py
+        if not self.swmr:
+            with h5py.File(self.file_name, "a") as f:
+                self._record_io(self.file_name, file_opens=1)
+                yield f
+            return
+
+        import shutil
+        tmp_file = "%s.%d.tmp" % (self.file_name, os.getpid())
+        shutil.copyfile(self.file_name, tmp_file)
+        try:
+            with h5py.File(tmp_file, "a") as f:
+                self._record_io(self.file_name, file_opens=1)
+                yield f
+            os.rename(tmp_file, self.file_name)
+        finally:
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+
+    @contextlib.contextmanager
+    def _edit_tpd(self):
+        """
+        Context manager that opens the .tpd file for writing groups that are not
+        part of the manifest (e.g. statistics). The cached manifest stays valid.
+        """
+        fresh = self._manifest is not None and self._get_tpd_stat() == self._manifest_stat
+        with self._open_tpd() as f:
+            yield f
+        if fresh:
+            self._manifest_stat = self._get_tpd_stat()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Context manager that collects all changes (set_*, add_*, clear_*) and
+        writes them to the .tpd file with a single open when the block ends.
+        If the block raises an exception, the changes are discarded.
+        """
+        self._get_manifest()
+        self._batch_depth += 1
+        success = False
+        try:
+            yield self
+            success = True
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                pending = self._pending
+                self._pending = {}
+                if not success:
+                    self._manifest = None
+                elif len(pending) > 0:
+                    self._write_manifest(pending)
 
     def _to_tpd_path(self, file_name):
         """
@@ -102,6 +781,7 @@ class TrainPredictData(object):
             path = os.path.join(self.base_path, file_name)
         return path
 
+    @_instrumented
     def _set_data(self, file_name, h5_key, tpd_path, tpd_key, tpd_shape):
         """Set file name and h5 key of the data.
 
@@ -114,28 +794,23 @@ class TrainPredictData(object):
         self._check_file_exists(file_name)
 
         # Read the shape of the new data set.
-        with h5py.File(file_name, "r") as f:
+        with self._files.open(file_name, keep=False) as f:
             if h5_key not in f.keys():
                 raise TPDError("_set_data(): The given h5 key does not exist in the given file.")
             new_shape = f[h5_key].shape
         new_count = self._get_count(new_shape)
 
-        with h5py.File(self.file_name, "a") as f:
-            # Check if the data shapes match.
-            if tpd_shape in f.keys():
-                shape = tuple(f[tpd_shape].value)
-                count = self._get_count(shape)
-                if new_count != count:
-                    raise TPDError("_set_data(): The numbers of instances do not match.")
-            else:
-                f[tpd_shape] = new_shape
-
-            if tpd_path in f.keys():
-                del f[tpd_path]
-            f[tpd_path] = self._to_tpd_path(file_name)
-            if tpd_key in f.keys():
-                del f[tpd_key]
-            f[tpd_key] = h5_key
+        # Check if the data shapes match.
+        manifest = self._get_manifest()
+        values = {tpd_path: self._to_tpd_path(file_name), tpd_key: h5_key}
+        if tpd_shape in manifest:
+            shape = tuple(manifest[tpd_shape])
+            count = self._get_count(shape)
+            if new_count != count and new_shape[0] != count:
+                raise TPDError("_set_data(): The numbers of instances do not match.")
+        else:
+            values[tpd_shape] = new_shape
+        self._write_manifest(values)
 
     def _get_data(self, tpd_path, tpd_key):
         """Return file name and h5 key of the data.
@@ -144,14 +819,179 @@ class TrainPredictData(object):
         :param tpd_key: tpd key of the h5 key
         :return: file name, h5 key
         """
-        with h5py.File(self.file_name, "r") as f:
-            if tpd_path not in f.keys() or tpd_key not in f.keys():
-                raise TPDError("_get_data(): The .tpd file does not contain the desired data.")
-            file_name = f[tpd_path].value
-            h5_key = f[tpd_key].value
+        manifest = self._get_manifest()
+        if tpd_path not in manifest or tpd_key not in manifest:
+            raise TPDError("_get_data(): The .tpd file does not contain the desired data.")
+        file_name = manifest[tpd_path]
+        h5_key = manifest[tpd_key]
         file_name = self._to_rel_path(file_name)
         return file_name, h5_key
 
+    @staticmethod
+    def _get_memmap(file_name, dset):
+        """
+        Return a read-only numpy.memmap of the given data set. This is only
+        possible for contiguous, uncompressed data sets with a plain numeric
+        dtype that are already allocated in the file. Otherwise None is returned.
+
+        :param file_name: name of the file that contains the data set
+        :param dset: h5py data set
+        :return: numpy.memmap or None
+        """
+        if dset.chunks is not None or dset.compression is not None or len(dset.shape) == 0:
+            return None
+        if dset.dtype.kind not in "biufc" or TrainPredictData._get_count(dset.shape) == 0:
+            return None
+        offset = dset.id.get_offset()
+        if offset is None:
+            return None
+        return numpy.memmap(file_name, dtype=dset.dtype, mode="r", offset=offset, shape=dset.shape)
+
+    @staticmethod
+    def _read_feature_mmap_into(mm, feats, current_feat, num_feats, rows=None, columns=None):
+        """
+        Copy the selected instances and features of a memory mapped feature data
+        set into the columns current_feat, current_feat+1, ... of feats.
+
+        :param mm: numpy.memmap of the feature data set
+        :param feats: (number of selected instances, d) numpy array
+        :param current_feat: index of the first column in feats
+        :param num_feats: number of features in the data set
+        :param rows: None (all instances), list of (start, stop) runs or sorted array of instance indices
+        :param columns: None (all features of the data set) or sorted array of feature indices inside the data set
+        :return: number of copied bytes
+        """
+        data = mm.reshape((-1, num_feats))
+        if columns is not None and num_feats == 1:
+            columns = None if len(columns) > 0 else columns
+        num_cols = num_feats if columns is None else len(columns)
+        if rows is None:
+            rows = [(0, data.shape[0])]
+        if isinstance(rows, list):
+            current_row = 0
+            for start, stop in rows:
+                block = data[start:stop] if columns is None else data[start:stop, columns]
+                feats[current_row:current_row+stop-start, current_feat:current_feat+num_cols] = block
+                current_row += stop-start
+            num_rows = current_row
+        else:
+            block = data[rows] if columns is None else data[rows[:, numpy.newaxis], columns]
+            feats[:, current_feat:current_feat+num_cols] = block
+            num_rows = len(rows)
+        return int(num_rows * num_cols * feats.itemsize)
+
+    def _get_vigra(self):
+        """Return the vigra module, or None if vigra is disabled or not available.
+
+        :return: vigra module or None
+        """
+        if not self.use_vigra:
+            return None
+        try:
+            import vigra
+        except ImportError:
+            return None
+        return vigra
+
+    def _read_data(self, file_name, h5_key, rows=None, mmap=False):
+        """Read the given data set using the pool of open files.
+
+        If rows is given, only the selected instances (indices into the
+        flattened data set) are read and returned as 1D array.
+
+        If mmap is True and the data set is contiguous and uncompressed, a
+        read-only numpy.memmap (without vigra axistags) is returned instead of
+        reading the data.
+
+        Whole data sets are read with vigra. If vigra is not available or
+        use_vigra is False, they are read with h5py. Both the h5py data and the
+        memmap are transposed, so they have the same (reversed) axis order as
+        the data that is read with vigra.
+
+        In SWMR mode, the data set is refreshed first, so data that is still
+        being written (e.g. predictions) is read up to its current size.
+
+        :param file_name: file name
+        :param h5_key: h5 key
+        :param rows: selected instances (None, slice, index array or boolean mask)
+        :param mmap: return a memory map if possible
+        :return: data
+        """
+        with self._files.open(file_name) as f:
+            if self.swmr:
+                f[h5_key].refresh()
+            if mmap:
+                mm = self._get_memmap(file_name, f[h5_key])
+                if mm is not None:
+                    if rows is not None:
+                        return mm.reshape(-1)[rows]
+                    return mm.transpose()
+            if rows is None:
+                vigra = self._get_vigra()
+                if vigra is not None:
+                    data = vigra.readHDF5(f, h5_key)
+                else:
+                    dset = f[h5_key]
+                    data = numpy.empty(dset.shape, dtype=dset.dtype)
+                    if data.size > 0:
+                        dset.read_direct(data)
+                    data = data.transpose()
+                self._record_io(file_name, bytes_read=data.nbytes)
+                return data
+            dset = f[h5_key]
+            row_sel, num_rows, row_inverse = self._normalize_index(rows, self._get_count(dset.shape))
+            data = numpy.empty((num_rows, 1), dtype=dset.dtype)
+            self._record_io(file_name, bytes_read=self._read_feature_into(dset, data, 0, 1, row_sel))
+        data = data.reshape(-1)
+        if row_inverse is not None:
+            data = data[row_inverse]
+        return data
+
+    def _iter_data_blocks(self, file_name, h5_key, block_shape, halo=0, prefetch=1):
+        """
+        Iterate over the given data set in blocks. The block shape is rounded up
+        to a multiple of the chunk shape, so every chunk is read only once
+        (except for the halo). The blocks are read in a background thread that
+        keeps the next prefetch blocks ready. The data has the axis order of the
+        h5 file.
+
+        :param file_name: file name
+        :param h5_key: h5 key
+        :param block_shape: shape of the blocks (int or tuple)
+        :param halo: number of additional voxels on each side of a block (int or tuple)
+        :param prefetch: number of blocks that are read in advance (0: no background thread)
+        :return: generator of Block
+        """
+        f = self._files.acquire(file_name)
+        try:
+            dset = f[h5_key]
+            shape = dset.shape
+            ndim = len(shape)
+            if isinstance(block_shape, int):
+                block_shape = (block_shape,) * ndim
+            if isinstance(halo, int):
+                halo = (halo,) * ndim
+            if len(block_shape) != ndim or len(halo) != ndim:
+                raise TPDError("_iter_data_blocks(): Block shape and halo must match the dimension of the data.")
+            if min(block_shape) <= 0 or min(halo) < 0:
+                raise TPDError("_iter_data_blocks(): The block shape must be positive and the halo non-negative.")
+            if dset.chunks is not None:
+                block_shape = tuple(min(s, -(-b // c) * c) for s, b, c in zip(shape, block_shape, dset.chunks))
+
+            def read_blocks():
+                for begin in itertools.product(*[xrange(0, s, b) for s, b in zip(shape, block_shape)]):
+                    end = tuple(min(b + bs, s) for b, bs, s in zip(begin, block_shape, shape))
+                    outer_begin = tuple(max(b - h, 0) for b, h in zip(begin, halo))
+                    outer_end = tuple(min(e + h, s) for e, h, s in zip(end, halo, shape))
+                    data = dset[tuple(slice(b, e) for b, e in zip(outer_begin, outer_end))]
+                    self._record_io(file_name, bytes_read=data.nbytes)
+                    yield Block(begin, end, outer_begin, outer_end, data)
+
+            for block in _prefetch(read_blocks(), prefetch):
+                yield block
+        finally:
+            self._files.release(file_name)
+
     def set_train_raw(self, file_name, h5_key):
         """Set file name and h5 key of the training raw data.
 
@@ -169,13 +1009,27 @@ class TrainPredictData(object):
         """
         return self._get_data(self._tpd_train_raw_path, self._tpd_train_raw_key)
 
-    def get_train_raw_data(self):
+    @_instrumented
+    def get_train_raw_data(self, rows=None, mmap=False):
         """Return the training raw data.
 
+        :param rows: if given, only the selected instances are read and returned as 1D array
+        :param mmap: return a read-only numpy.memmap if the data set is contiguous and uncompressed
         :return: training raw data
         """
         file_name, h5_key = self.get_train_raw()
-        return vigra.readHDF5(file_name, h5_key)
+        return self._read_data(file_name, h5_key, rows, mmap)
+
+    def iter_train_raw_blocks(self, block_shape, halo=0, prefetch=1):
+        """Iterate over blocks of the training raw data (see _iter_data_blocks).
+
+        :param block_shape: shape of the blocks (int or tuple)
+        :param halo: number of additional voxels on each side of a block (int or tuple)
+        :param prefetch: number of blocks that are read in advance
+        :return: generator of Block
+        """
+        file_name, h5_key = self.get_train_raw()
+        return self._iter_data_blocks(file_name, h5_key, block_shape, halo, prefetch)
 
     def set_train_gt(self, file_name, h5_key):
         """Set file name and h5 key of the training gt data.
@@ -194,13 +1048,27 @@ class TrainPredictData(object):
         """
         return self._get_data(self._tpd_train_gt_path, self._tpd_train_gt_key)
 
-    def get_train_gt_data(self):
+    @_instrumented
+    def get_train_gt_data(self, rows=None, mmap=False):
         """Return the training gt data.
 
+        :param rows: if given, only the selected instances are read and returned as 1D array
+        :param mmap: return a read-only numpy.memmap if the data set is contiguous and uncompressed
         :return: training gt data
         """
         file_name, h5_key = self.get_train_gt()
-        return vigra.readHDF5(file_name, h5_key)
+        return self._read_data(file_name, h5_key, rows, mmap)
+
+    def iter_train_gt_blocks(self, block_shape, halo=0, prefetch=1):
+        """Iterate over blocks of the training gt data (see _iter_data_blocks).
+
+        :param block_shape: shape of the blocks (int or tuple)
+        :param halo: number of additional voxels on each side of a block (int or tuple)
+        :param prefetch: number of blocks that are read in advance
+        :return: generator of Block
+        """
+        file_name, h5_key = self.get_train_gt()
+        return self._iter_data_blocks(file_name, h5_key, block_shape, halo, prefetch)
 
     def set_test_raw(self, file_name, h5_key):
         """Set file name and h5 key of the test raw data.
@@ -219,13 +1087,27 @@ class TrainPredictData(object):
         """
         return self._get_data(self._tpd_test_raw_path, self._tpd_test_raw_key)
 
-    def get_test_raw_data(self):
+    @_instrumented
+    def get_test_raw_data(self, rows=None, mmap=False):
         """Return the test raw data.
 
+        :param rows: if given, only the selected instances are read and returned as 1D array
+        :param mmap: return a read-only numpy.memmap if the data set is contiguous and uncompressed
         :return: test raw data
         """
         file_name, h5_key = self.get_test_raw()
-        return vigra.readHDF5(file_name, h5_key)
+        return self._read_data(file_name, h5_key, rows, mmap)
+
+    def iter_test_raw_blocks(self, block_shape, halo=0, prefetch=1):
+        """Iterate over blocks of the test raw data (see _iter_data_blocks).
+
+        :param block_shape: shape of the blocks (int or tuple)
+        :param halo: number of additional voxels on each side of a block (int or tuple)
+        :param prefetch: number of blocks that are read in advance
+        :return: generator of Block
+        """
+        file_name, h5_key = self.get_test_raw()
+        return self._iter_data_blocks(file_name, h5_key, block_shape, halo, prefetch)
 
     def set_test_gt(self, file_name, h5_key):
         """Set file name and h5 key of the test gt data.
@@ -244,57 +1126,123 @@ class TrainPredictData(object):
         """
         return self._get_data(self._tpd_test_gt_path, self._tpd_test_gt_key)
 
-    def get_test_gt_data(self):
+    @_instrumented
+    def get_test_gt_data(self, rows=None, mmap=False):
         """Return the test gt data.
 
+        :param rows: if given, only the selected instances are read and returned as 1D array
+        :param mmap: return a read-only numpy.memmap if the data set is contiguous and uncompressed
         :return: test gt data
         """
         file_name, h5_key = self.get_test_gt()
-        return vigra.readHDF5(file_name, h5_key)
+        return self._read_data(file_name, h5_key, rows, mmap)
+
+    def iter_test_gt_blocks(self, block_shape, halo=0, prefetch=1):
+        """Iterate over blocks of the test gt data (see _iter_data_blocks).
 
-    def _add_feature(self, file_name, h5_key, tpd_key, tpd_shape):
+        :param block_shape: shape of the blocks (int or tuple)
+        :param halo: number of additional voxels on each side of a block (int or tuple)
+        :param prefetch: number of blocks that are read in advance
+        :return: generator of Block
         """
-        Add the given feature to the training or test data, depending on the tpd key.
-        The feature will only be added, if it is not already in the feature list.
+        file_name, h5_key = self.get_test_gt()
+        return self._iter_data_blocks(file_name, h5_key, block_shape, halo, prefetch)
 
-        :param file_name: file name
-        :param h5_key: h5 key
+    @_instrumented
+    def _add_features(self, features, tpd_key, tpd_shape):
+        """
+        Add the given features to the training or test data, depending on the tpd key.
+        A feature is only added, if it is not already in the feature list. All
+        files are checked first, then the feature list is written in one step.
+
+        :param features: list with (file name, h5 key) tuples
         :param tpd_key: key in the .tpd file
         :param tpd_shape: key in the .tpd file with the shape of the data
         """
-        self._check_file_exists(file_name)
-        to_add = [self._to_tpd_path(file_name), h5_key]
+        manifest = self._get_manifest()
+        count = self._get_count(tuple(manifest[tpd_shape])) if tpd_shape in manifest else None
+
+        # Read the instance counts from the given files.
+        new_features = []
+        for file_name, h5_key in features:
+            self._check_file_exists(file_name)
+            with self._files.open(file_name, keep=False) as f:
+                if h5_key not in f.keys():
+                    raise TPDError("_add_features(): The given h5 key does not exist in the given file.")
+                new_info = self._get_feature_info(file_name, f[h5_key])
+            new_shape = tuple(new_info["shape"])
+            if count is not None and new_shape[0] != count and self._get_count(new_shape) != count:
+                raise TPDError("_add_features(): The numbers of instances do not match.")
+            new_features.append(([self._to_tpd_path(file_name), h5_key], new_info))
+
+        # Append the new features to the feature list.
+        manifest = self._get_manifest()
+        if tpd_key in manifest:
+            feature_list = manifest[tpd_key].tolist()
+        else:
+            feature_list = []
+        known = set(tuple(entry) for entry in feature_list)
+        infos = None
+        for to_add, new_info in new_features:
+            if tuple(to_add) in known:
+                continue
+            if infos is None:
+                infos = self._get_feature_infos(tpd_key, len(feature_list))
+            known.add(tuple(to_add))
+            feature_list.append(to_add)
+            infos.append(new_info)
+        if infos is not None:
+            self._write_manifest({tpd_key: numpy.array(feature_list),
+                                  tpd_key + self._tpd_info_suffix: self._to_info_array(infos)})
 
-        # Read the instance count from the given file.
-        with h5py.File(file_name, "r") as f:
-            if h5_key not in f.keys():
-                raise TPDError("_add_feature(): The given h5 key does not exist in the given file.")
-            new_shape = f[h5_key].shape
-        new_shape_count = self._get_count(new_shape)
-        new_count = new_shape[0]
-
-        # Append the new feature to the feature list.
-        with h5py.File(self.file_name, "a") as f:
-            # Get the current feature list.
-            if tpd_key in f.keys():
-                feature_list = f[tpd_key].value.tolist()
-            else:
-                feature_list = []
+    @staticmethod
+    def _get_feature_info(file_name, dset):
+        """
+        Return a dict with shape, dtype, chunks, compression, mtime and size of a
+        feature data set. For quantized features, the per-feature scale and offset
+        are added.
 
-            # Get the shape of the old data.
-            if tpd_shape in f.keys():
-                shape = tuple(f[tpd_shape].value)
-                count = self._get_count(shape)
-                if new_count != count and new_shape_count != count:
-                    raise TPDError("_add_feature(): The numbers of instances do not match.")
+        :param file_name: name of the file that contains the data set
+        :param dset: h5py data set
+        :return: feature info
+        """
+        mtime, size = _get_file_stat(file_name)
+        info = {"shape": [int(s) for s in dset.shape],
+                "dtype": dset.dtype.str,
+                "chunks": None if dset.chunks is None else [int(c) for c in dset.chunks],
+                "compression": dset.compression,
+                "mtime": mtime,
+                "size": size}
+        if "tpd_scale" in dset.attrs:
+            info["scale"] = [float(v) for v in numpy.ravel(dset.attrs["tpd_scale"])]
+            info["offset"] = [float(v) for v in numpy.ravel(dset.attrs["tpd_offset"])]
+        return info
 
-            # Append the feature to the list.
-            if to_add not in feature_list:
-                feature_list.append(to_add)
+    @staticmethod
+    def _to_info_array(infos):
+        """Convert a list of feature infos to an array that can be stored in the .tpd file.
+
+        :param infos: list with feature infos
+        :return: numpy array with json strings
+        """
+        return numpy.array([json.dumps(info) for info in infos])
 
-            if tpd_key in f.keys():
-                del f[tpd_key]
-            f[tpd_key] = numpy.array(feature_list)
+    def _get_feature_infos(self, tpd_key, num_features):
+        """
+        Return the stored feature infos of the given feature list. Entries are
+        None if the .tpd file does not contain the infos.
+
+        :param tpd_key: tpd key of the feature list
+        :param num_features: number of features in the feature list
+        :return: list with feature infos
+        """
+        manifest = self._get_manifest()
+        info_key = tpd_key + self._tpd_info_suffix
+        if info_key in manifest:
+            infos = [json.loads(info) for info in manifest[info_key].tolist()]
+            if len(infos) == num_features:
+                return infos
+        return [None] * num_features
 
     def add_train_feature(self, file_name, h5_key):
         """Add the given training feature, but only if it is not already in the feature list.
@@ -302,7 +1250,7 @@ class TrainPredictData(object):
         :param file_name: file name
         :param h5_key: h5 key
         """
-        self._add_feature(file_name, h5_key, self._tpd_train_feat, self._tpd_train_shape)
+        self._add_features([(file_name, h5_key)], self._tpd_train_feat, self._tpd_train_shape)
 
     def add_test_feature(self, file_name, h5_key):
         """Add the given test feature, but only if it is not already in the feature list.
@@ -310,7 +1258,138 @@ class TrainPredictData(object):
         :param file_name: file name
         :param h5_key: h5 key
         """
-        self._add_feature(file_name, h5_key, self._tpd_test_feat, self._tpd_test_shape)
+        self._add_features([(file_name, h5_key)], self._tpd_test_feat, self._tpd_test_shape)
+
+    def _quantize_feature(self, file_name, h5_key, out_file, out_key, dtype, tpd_key, tpd_shape, compression=None):
+        """
+        Write a reduced precision copy of the given feature data set. Integer
+        dtypes use an affine quantization per feature: The range [min, max] of
+        each feature is mapped to [0, 2**bits-1] and scale and offset are stored
+        as attributes of the new data set. Float dtypes (e.g. float16) are
+        written as plain copy.
+
+        :param file_name: file name of the feature
+        :param h5_key: h5 key of the feature
+        :param out_file: file name of the quantized feature
+        :param out_key: h5 key of the quantized feature
+        :param dtype: stored dtype (e.g. numpy.uint8, numpy.uint16 or numpy.float16)
+        :param tpd_key: tpd key of the feature list
+        :param tpd_shape: tpd key of the shape of the raw data
+        :param compression: compression of the new data set (e.g. "gzip")
+        """
+        import h5py
+        dtype = numpy.dtype(dtype)
+        if dtype.kind not in "uf":
+            raise TPDError("_quantize_feature(): The dtype must be an unsigned integer or a float type.")
+        self._check_file_exists(file_name)
+        manifest = self._get_manifest()
+        with self._files.open(file_name, keep=False) as f:
+            if h5_key not in f.keys():
+                raise TPDError("_quantize_feature(): The given h5 key does not exist in the given file.")
+            shape = f[h5_key].shape
+        # The number of instances is determined like in _get_feature_layout.
+        if tpd_shape in manifest:
+            count = self._get_count(tuple(manifest[tpd_shape]))
+        elif tpd_key in manifest:
+            _, count, _, _ = self._get_feature_layout(tpd_key, tpd_shape)
+        else:
+            count = None
+        if count is not None and self._get_count(shape) != count and shape[0] != count:
+            raise TPDError("_quantize_feature(): The numbers of instances do not match.")
+        if count is None or self._get_count(shape) == count:
+            num_feats = 1
+        else:
+            num_feats = self._get_count(shape[1:])
+        slab_rows = max(1, 2**24 // (8 * max(self._get_count(shape[1:]), 1)))
+
+        def iter_slabs():
+            with self._files.open(file_name, keep=False) as f:
+                dset = f[h5_key]
+                for start in xrange(0, shape[0], slab_rows):
+                    data = dset[start:start+slab_rows]
+                    self._record_io(file_name, bytes_read=data.nbytes)
+                    yield start, data
+
+        # Get the range of each feature.
+        scale = None
+        if dtype.kind == "u":
+            fmin = numpy.full(num_feats, numpy.inf)
+            fmax = numpy.full(num_feats, -numpy.inf)
+            for _, data in iter_slabs():
+                data = data.reshape(-1, num_feats)
+                numpy.minimum(fmin, data.min(axis=0), out=fmin)
+                numpy.maximum(fmax, data.max(axis=0), out=fmax)
+            offset = numpy.where(numpy.isfinite(fmin), fmin, 0)
+            scale = (fmax - offset) / float(numpy.iinfo(dtype).max)
+            scale[~(scale > 0)] = 1
+
+        self._files.discard(out_file)
+        with h5py.File(out_file, "a") as f:
+            self._record_io(out_file, file_opens=1)
+            if out_key in f.keys():
+                del f[out_key]
+            chunk_rows = max(1, min(shape[0], 2**20 // (dtype.itemsize * max(self._get_count(shape[1:]), 1))))
+            out = f.create_dataset(out_key, shape=shape, dtype=dtype, chunks=(chunk_rows,) + tuple(shape[1:]),
+                                   maxshape=(None,) + tuple(shape[1:]), compression=compression)
+            for start, data in iter_slabs():
+                if scale is not None:
+                    data = numpy.rint((data.reshape(-1, num_feats) - offset) / scale).reshape(data.shape)
+                out[start:start+len(data)] = data
+                self._record_io(out_file, bytes_written=len(data) * out.dtype.itemsize *
+                                self._get_count(shape[1:]))
+            if scale is not None:
+                out.attrs["tpd_scale"] = scale
+                out.attrs["tpd_offset"] = offset
+
+    def add_train_feature_quantized(self, file_name, h5_key, out_file, out_key, dtype=numpy.uint8,
+                                    compression=None):
+        """
+        Write a reduced precision copy of the given training feature (see
+        _quantize_feature) and add it to the feature list. The features are
+        dequantized when they are read.
+
+        :param file_name: file name of the feature
+        :param h5_key: h5 key of the feature
+        :param out_file: file name of the quantized feature
+        :param out_key: h5 key of the quantized feature
+        :param dtype: stored dtype (e.g. numpy.uint8, numpy.uint16 or numpy.float16)
+        :param compression: compression of the new data set (e.g. "gzip")
+        """
+        self._quantize_feature(file_name, h5_key, out_file, out_key, dtype, self._tpd_train_feat,
+                               self._tpd_train_shape, compression)
+        self.add_train_feature(out_file, out_key)
+
+    def add_test_feature_quantized(self, file_name, h5_key, out_file, out_key, dtype=numpy.uint8,
+                                   compression=None):
+        """
+        Write a reduced precision copy of the given test feature (see
+        _quantize_feature) and add it to the feature list. The features are
+        dequantized when they are read.
+
+        :param file_name: file name of the feature
+        :param h5_key: h5 key of the feature
+        :param out_file: file name of the quantized feature
+        :param out_key: h5 key of the quantized feature
+        :param dtype: stored dtype (e.g. numpy.uint8, numpy.uint16 or numpy.float16)
+        :param compression: compression of the new data set (e.g. "gzip")
+        """
+        self._quantize_feature(file_name, h5_key, out_file, out_key, dtype, self._tpd_test_feat,
+                               self._tpd_test_shape, compression)
+        self.add_test_feature(out_file, out_key)
+
+    def add_train_features(self, features):
+        """Add the given training features with a single write to the .tpd file.
+
+        :param features: list with (file name, h5 key) tuples
+        """
+        self._add_features(features, self._tpd_train_feat, self._tpd_train_shape)
+
+    def add_test_features(self, features):
+        """Add the given test features with a single write to the .tpd file.
+
+        :param features: list with (file name, h5 key) tuples
+        """
+        self._add_features(features, self._tpd_test_feat, self._tpd_test_shape)
 
     def _get_feature_file(self, tpd_key, i):
         """Get file name and h5 key of the feature with index i.
@@ -319,10 +1398,10 @@ class TrainPredictData(object):
         :param i: feature index
         :return: file name, h5 key
         """
-        with h5py.File(self.file_name, "r") as f:
-            if tpd_key not in f.keys():
-                raise TPDError("_get_feature_file(): There are no features in the .tpd file.")
-            feature_list = f[tpd_key].value.tolist()
+        manifest = self._get_manifest()
+        if tpd_key not in manifest:
+            raise TPDError("_get_feature_file(): There are no features in the .tpd file.")
+        feature_list = manifest[tpd_key].tolist()
 
         if i < 0 or i >= len(feature_list):
             raise TPDError("_get_feature_file(): Index out of range.")
@@ -344,32 +1423,52 @@ class TrainPredictData(object):
         """
         return self._get_feature_file(self._tpd_test_feat, i)
 
-    def _get_feature_data(self, tpd_key, tpd_shape):
-        """Get the features of the desired data set.
+    @_instrumented
+    def _get_feature_layout(self, tpd_key, tpd_shape):
+        """
+        Check that the number of instances in all feature files is correct and
+        get the number of features that are inside each feature file.
+
+        The shapes are taken from the feature infos in the .tpd file. A feature
+        file is only opened if its modification time or size does not match the
+        stored info. In this case, the updated info is only kept in the cached
+        manifest (it is written to the .tpd file by the next add_* call), so
+        reading never writes the .tpd file.
 
         :param tpd_key: tpd key of the data
         :param tpd_shape: tpd key of the shape of the raw data
-        :return: features of the desired data set
+        :return: feature list (file names relative to the working directory), number of instances, number of features per file, feature infos
         """
-        with h5py.File(self.file_name, "r") as f:
-            if tpd_key not in f.keys():
-                raise TPDError("_get_feature_data(): There are no features in the .tpd file.")
-            feature_list = f[tpd_key].value.tolist()
-            if tpd_shape in f.keys():
-                shape = tuple(f[tpd_shape].value)
-                count = self._get_count(shape)
-            else:
-                shape = None
+        manifest = self._get_manifest()
+        if tpd_key not in manifest:
+            raise TPDError("_get_feature_layout(): There are no features in the .tpd file.")
+        feature_list = manifest[tpd_key].tolist()
+        infos = self._get_feature_infos(tpd_key, len(feature_list))
+        if tpd_shape in manifest:
+            shape = tuple(manifest[tpd_shape])
+            count = self._get_count(shape)
+        else:
+            shape = None
 
-        # Check that the number of instances in all feature files is correct and get the number of features.
         num_all_feats = []
-        for file_path, h5_key in feature_list:
-            # Read the shape of the feature data.
+        infos_changed = False
+        for i in xrange(len(feature_list)):
+            file_path, h5_key = feature_list[i]
             file_path = self._to_rel_path(file_path)
-            with h5py.File(file_path, "r") as f:
-                if h5_key not in f.keys():
-                    raise TPDError("_get_feature_data(): The h5 key does not exist in the given file.")
-                new_shape = f[h5_key].shape
+            feature_list[i] = [file_path, h5_key]
+
+            # Read the shape of the feature data, if the stored info is outdated.
+            info = infos[i]
+            if info is None or not os.path.isfile(file_path) or \
+                    _get_file_stat(file_path) != (info["mtime"], info["size"]):
+                self._check_file_exists(file_path)
+                with self._files.open(file_path) as f:
+                    if h5_key not in f.keys():
+                        raise TPDError("_get_feature_layout(): The h5 key does not exist in the given file.")
+                    info = self._get_feature_info(file_path, f[h5_key])
+                infos[i] = info
+                infos_changed = True
+            new_shape = tuple(info["shape"])
             new_count = self._get_count(new_shape)
             if shape is None:
                 shape = new_shape
@@ -381,48 +1480,1307 @@ class TrainPredictData(object):
             elif new_shape[0] == count:
                 num_all_feats.append(self._get_count(new_shape[1:]))
             else:
-                raise TPDError("_get_feature_data(): The numbers of instances do not match.")
+                raise TPDError("_get_feature_layout(): The numbers of instances do not match.")
 
-        # Write all features into a single numpy array.
-        feats = numpy.zeros((count, sum(num_all_feats)))
-        current_feat = 0
-        for i in xrange(len(num_all_feats)):
-            file_path, h5_key = feature_list[i]
-            file_path = self._to_rel_path(file_path)
-            num_feats = num_all_feats[i]
+        # Keep the updated infos in memory until the .tpd file is reloaded.
+        if infos_changed:
+            manifest[tpd_key + self._tpd_info_suffix] = self._to_info_array(infos)
+        return feature_list, count, num_all_feats, infos
+
+    @staticmethod
+    def _flat_range_boxes(shape, start, stop):
+        """
+        Split the range start, ..., stop-1 of the flattened (C order) indices of
+        an array with the given shape into boxes (hyperslabs).
+
+        :param shape: shape of the array
+        :param start: first flat index
+        :param stop: flat index after the last one
+        :return: list with (offset, count) tuples of the boxes
+        """
+        if start >= stop:
+            return []
+        if len(shape) <= 1:
+            return [((start,), (stop-start,))]
+        inner = TrainPredictData._get_count(shape[1:])
+        first, first_rest = divmod(start, inner)
+        last, last_rest = divmod(stop, inner)
+        if first == last:
+            return [((first,) + off, (1,) + cnt)
+                    for off, cnt in TrainPredictData._flat_range_boxes(shape[1:], first_rest, last_rest)]
+        boxes = []
+        if first_rest > 0:
+            boxes += [((first,) + off, (1,) + cnt)
+                      for off, cnt in TrainPredictData._flat_range_boxes(shape[1:], first_rest, inner)]
+            first += 1
+        if last > first:
+            boxes.append(((first,) + (0,)*(len(shape)-1), (last-first,) + tuple(shape[1:])))
+        if last_rest > 0:
+            boxes += [((last,) + off, (1,) + cnt)
+                      for off, cnt in TrainPredictData._flat_range_boxes(shape[1:], 0, last_rest)]
+        return boxes
+
+    @staticmethod
+    def _normalize_index(index, n):
+        """
+        Convert an index (None, slice, index array or boolean mask) along an axis
+        of length n into a selection that can be read from HDF5.
+
+        The selection is either a list of (start, stop) runs or a sorted array of
+        unique indices. Index arrays that consist of few contiguous runs are
+        converted to runs, because reading hyperslabs is much faster than reading
+        single points. If the requested order differs from the sorted order, the
+        inverse maps the sorted result to the requested order.
+
+        :param index: None (everything), slice, index array or boolean mask
+        :param n: length of the axis
+        :return: selection, number of selected indices, inverse (or None)
+        """
+        if index is None:
+            return [(0, n)], n, None
+        if isinstance(index, slice):
+            start, stop, step = index.indices(n)
+            if step == 1:
+                stop = max(start, stop)
+                return [(start, stop)], stop-start, None
+            index = numpy.arange(start, stop, step)
+        index = numpy.asarray(index)
+        if index.dtype == bool:
+            if index.shape != (n,):
+                raise TPDError("_normalize_index(): The boolean mask does not match the number of elements.")
+            index = numpy.flatnonzero(index)
+        elif index.dtype.kind not in "iu" and index.size > 0:
+            raise TPDError("_normalize_index(): The index must be a slice, an integer array or a boolean mask.")
+        index = index.reshape(-1).astype(numpy.int64)
+        index[index < 0] += n
+        if len(index) > 0 and (index.min() < 0 or index.max() >= n):
+            raise TPDError("_normalize_index(): Index out of range.")
+
+        indices, inverse = numpy.unique(index, return_inverse=True)
+        if len(indices) == len(index) and (indices == index).all():
+            inverse = None
+        breaks = numpy.flatnonzero(numpy.diff(indices) != 1) + 1
+        if len(breaks) < TrainPredictData._max_hyperslab_runs:
+            starts = indices[numpy.concatenate(([0], breaks))] if len(indices) > 0 else []
+            stops = indices[numpy.concatenate((breaks-1, [len(indices)-1]))] + 1 if len(indices) > 0 else []
+            return [(int(start), int(stop)) for start, stop in zip(starts, stops)], len(indices), inverse
+        return indices, len(indices), inverse
+
+    @staticmethod
+    def _selection_to_indices(selection):
+        """Convert a selection of _normalize_index into a sorted array of indices.
+
+        :param selection: list of (start, stop) runs or sorted index array
+        :return: sorted index array
+        """
+        if isinstance(selection, list):
+            if len(selection) == 0:
+                return numpy.zeros(0, dtype=numpy.int64)
+            return numpy.concatenate([numpy.arange(start, stop) for start, stop in selection])
+        return selection
+
+    @staticmethod
+    def _read_feature_into(dset, feats, current_feat, num_feats, rows=None, columns=None):
+        """
+        Read the selected instances and features of a feature data set directly
+        into the columns current_feat, current_feat+1, ... of feats.
+
+        Only the selected elements are read from the file: runs of instances are
+        read as hyperslabs, sparse single instances as points. If the single
+        instances are dense in their chunks, the chunks are read as hyperslabs
+        and the instances are selected in memory. The low level h5py
+        interface is used, because read_direct cannot broadcast a volume (a
+        single feature for each voxel) into a column. HDF5 converts the data to
+        the dtype of feats while reading.
+
+        :param dset: h5py data set with the feature data
+        :param feats: C contiguous (number of selected instances, d) numpy array
+        :param current_feat: index of the first column in feats
+        :param num_feats: number of features in the data set
+        :param rows: None (all instances), list of (start, stop) runs or sorted array of instance indices
+        :param columns: None (all features of the data set) or sorted array of feature indices inside the data set
+        :return: number of read bytes
+        """
+        from h5py import h5s
+        if rows is None:
+            rows = [(0, TrainPredictData._get_count(dset.shape) // num_feats)]
+        if columns is not None and num_feats == 1:
+            columns = None if len(columns) > 0 else columns
+        num_cols = num_feats if columns is None else len(columns)
+        if isinstance(rows, list):
+            num_rows = sum(stop-start for start, stop in rows)
+        else:
+            num_rows = len(rows)
+        if num_rows == 0 or num_cols == 0:
+            return 0
+
+        mspace = h5s.create_simple(feats.shape)
+        mspace.select_hyperslab((0, current_feat), (num_rows, num_cols))
+        fspace = dset.id.get_space()
+        if isinstance(rows, list):
+            fspace.select_none()
+            for start, stop in rows:
+                if columns is None:
+                    for offset, count in TrainPredictData._flat_range_boxes(dset.shape, start*num_feats, stop*num_feats):
+                        fspace.select_hyperslab(offset, count, op=h5s.SELECT_OR)
+                else:
+                    for c in columns:
+                        offset = (start,) + tuple(int(i) for i in numpy.unravel_index(c, dset.shape[1:]))
+                        count = (stop-start,) + (1,) * (len(dset.shape)-1)
+                        fspace.select_hyperslab(offset, count, op=h5s.SELECT_OR)
+        else:
+            rows = numpy.asarray(rows)
+            covering = TrainPredictData._get_covering_runs(dset, num_feats, rows)
+            if covering is not None:
+                return TrainPredictData._read_covering_runs(dset, feats, current_feat, num_feats, rows, columns,
+                                                            covering)
+            cols = numpy.arange(num_feats) if columns is None else numpy.asarray(columns)
+            flat = (rows[:, numpy.newaxis] * num_feats + cols[numpy.newaxis, :]).reshape(-1)
+            coords = numpy.array(numpy.unravel_index(flat, dset.shape)).T
+            fspace.select_elements(numpy.ascontiguousarray(coords, dtype=numpy.uint64))
+        dset.id.read(mspace, fspace, feats)
+        return int(num_rows * num_cols * feats.itemsize)
+
+    @staticmethod
+    def _get_covering_runs(dset, num_feats, rows):
+        """
+        Return the runs of instances that cover the chunks (or 64 KiB blocks of
+        contiguous data sets) with the given instances, or None if the instances
+        are too sparse and should be read as points.
+
+        :param dset: h5py data set with the feature data
+        :param num_feats: number of features in the data set
+        :param rows: sorted array of instance indices
+        :return: None or list of (start, stop) runs
+        """
+        n = TrainPredictData._get_count(dset.shape) // num_feats
+        if dset.chunks is not None:
+            block_rows = TrainPredictData._get_count((dset.chunks[0],) + tuple(dset.shape[1:])) // num_feats
+        else:
+            block_rows = 2**16 // (num_feats * dset.dtype.itemsize)
+        block_rows = max(1, int(block_rows))
+        blocks = numpy.unique(rows // block_rows)
+        if len(rows) < TrainPredictData._point_selection_density * len(blocks) * block_rows:
+            return None
+        breaks = numpy.flatnonzero(numpy.diff(blocks) != 1) + 1
+        starts = blocks[numpy.concatenate(([0], breaks))] * block_rows
+        stops = numpy.minimum((blocks[numpy.concatenate((breaks-1, [len(blocks)-1]))] + 1) * block_rows, n)
+        return [(int(start), int(stop)) for start, stop in zip(starts, stops)]
+
+    @staticmethod
+    def _read_covering_runs(dset, feats, current_feat, num_feats, rows, columns, covering):
+        """
+        Read the covering runs of the given instances in groups of at most
+        _max_covering_bytes and copy the instances into the columns
+        current_feat, current_feat+1, ... of feats.
+
+        :param dset: h5py data set with the feature data
+        :param feats: C contiguous (number of selected instances, d) numpy array
+        :param current_feat: index of the first column in feats
+        :param num_feats: number of features in the data set
+        :param rows: sorted array of instance indices
+        :param columns: None (all features of the data set) or sorted array of feature indices inside the data set
+        :param covering: list of (start, stop) runs that contain all instances
+        :return: number of read bytes
+        """
+        num_cols = num_feats if columns is None else len(columns)
+        max_rows = max(1, TrainPredictData._max_covering_bytes // (num_cols * feats.itemsize))
+        pieces = [(b, min(b+max_rows, stop)) for start, stop in covering for b in xrange(start, stop, max_rows)]
+        nbytes = 0
+        group = []
+        group_rows = 0
+        for i, (start, stop) in enumerate(pieces):
+            group.append((start, stop))
+            group_rows += stop - start
+            if i+1 < len(pieces) and group_rows + pieces[i+1][1] - pieces[i+1][0] <= max_rows:
+                continue
+            tmp = numpy.empty((group_rows, num_cols), dtype=feats.dtype)
+            nbytes += TrainPredictData._read_feature_into(dset, tmp, 0, num_feats, group, columns)
+            starts = numpy.array([b for b, _ in group])
+            offsets = numpy.cumsum([0] + [e-b for b, e in group[:-1]])
+            first, last = numpy.searchsorted(rows, [group[0][0], group[-1][1]])
+            selected = rows[first:last]
+            runs = numpy.searchsorted(starts, selected, side="right") - 1
+            feats[first:last, current_feat:current_feat+num_cols] = tmp[offsets[runs] + selected - starts[runs]]
+            group = []
+            group_rows = 0
+        return nbytes
+
+    @staticmethod
+    def _get_dequantization(infos, num_all_feats):
+        """Return scale and offset of all features, or None if no feature is quantized.
+
+        :param infos: feature infos
+        :param num_all_feats: number of features per file
+        :return: None or (scale, offset)
+        """
+        if not any("scale" in info for info in infos):
+            return None
+        scale = []
+        offset = []
+        for info, num_feats in zip(infos, num_all_feats):
+            if "scale" in info and len(info["scale"]) != num_feats:
+                raise TPDError("_get_dequantization(): The number of stored scales does not match the number of "
+                               "features.")
+            scale += info.get("scale", [1.0] * num_feats)
+            offset += info.get("offset", [0.0] * num_feats)
+        return numpy.array(scale), numpy.array(offset)
 
-            # Read the feature data.
-            with h5py.File(file_path, "r") as f:
-                feat = f[h5_key].value
-            feat = feat.reshape((count, num_feats))
+    @staticmethod
+    def _get_read_dtype(dtype, dequantization):
+        """
+        Return the dtype the features are read with. Quantized features are read
+        as float, so they can be dequantized before they are converted to an
+        integer dtype.
 
-            # Write all features into the feature array.
-            for k in xrange(num_feats):
-                feats[:, current_feat] = feat[:, k]
-                current_feat += 1
+        :param dtype: requested dtype
+        :param dequantization: None or (scale, offset) of all features
+        :return: dtype for reading
+        """
+        if dequantization is not None and numpy.dtype(dtype).kind != "f":
+            return numpy.dtype(numpy.float64)
+        return numpy.dtype(dtype)
 
+    @staticmethod
+    def _dequantize(feats, dequantization, columns=None, dtype=None):
+        """
+        Convert the quantized columns of feats (in place) to the original values
+        and convert the result to the requested dtype.
+
+        :param feats: (n, d) numpy array (read with _get_read_dtype)
+        :param dequantization: None or (scale, offset) of all features
+        :param columns: None (feats has all features) or sorted indices of the features in feats
+        :param dtype: requested dtype (None: dtype of feats)
+        :return: features
+        """
+        if dequantization is not None:
+            TrainPredictData._dequantize_columns(feats, dequantization, columns)
+        if dtype is not None and feats.dtype != numpy.dtype(dtype):
+            feats = feats.astype(dtype)
         return feats
 
-    def get_train_features(self):
+    @staticmethod
+    def _dequantize_columns(feats, dequantization, columns=None):
+        """Convert the quantized columns of the float array feats in place to the original values.
+
+        :param feats: (n, d) numpy array with float dtype
+        :param dequantization: (scale, offset) of all features
+        :param columns: None (feats has all features) or sorted indices of the features in feats
+        """
+        scale, offset = dequantization
+        if columns is not None:
+            scale = scale[columns]
+            offset = offset[columns]
+        cols = numpy.flatnonzero((scale != 1) | (offset != 0))
+        if len(cols) == feats.shape[1]:
+            feats *= scale
+            feats += offset
+        elif len(cols) > 0:
+            feats[:, cols] = feats[:, cols] * scale[cols] + offset[cols]
+
+    def _get_cache_file_name(self):
+        """Return the name of the file that caches the assembled feature matrices.
+
+        :return: file name of the .tpdcache file
+        """
+        return os.path.splitext(self.file_name)[0] + ".tpdcache"
+
+    @staticmethod
+    def _get_feature_signature(feature_list, infos):
+        """
+        Return a string that changes whenever the feature list or one of the
+        referenced feature files (shape, dtype, mtime, size) changes.
+
+        :param feature_list: feature list (file names relative to the working directory)
+        :param infos: feature infos
+        :return: signature
+        """
+        items = [[os.path.abspath(file_path), h5_key, info["shape"], info["dtype"], info["mtime"], info["size"]]
+                 for (file_path, h5_key), info in zip(feature_list, infos)]
+        return hashlib.sha1(json.dumps(items).encode("utf-8")).hexdigest()
+
+    def _read_feature_cache(self, tpd_key, signature, dtype):
+        """Read the cached feature matrix, if it exists and is up to date.
+
+        :param tpd_key: tpd key of the data
+        :param signature: current signature of the feature list
+        :param dtype: dtype of the features
+        :return: features or None
+        """
+        cache_file = self._get_cache_file_name()
+        if not os.path.isfile(cache_file):
+            return None
+        try:
+            with self._files.open(cache_file) as f:
+                if tpd_key not in f.keys():
+                    return None
+                dset = f[tpd_key]
+                if dset.attrs.get("signature") != signature or dset.dtype != numpy.dtype(dtype):
+                    return None
+                feats = numpy.empty(dset.shape, dtype=dtype)
+                dset.read_direct(feats)
+                self._record_io(cache_file, bytes_read=feats.nbytes)
+                return feats
+        except (IOError, OSError):
+            return None
+
+    def _write_feature_cache(self, tpd_key, signature, feats):
+        """
+        Write the feature matrix to the cache file. The matrix is first written
+        to a temporary data set and then renamed, so readers never see a partial
+        matrix. Nothing is cached if the cache file cannot be written.
+
+        :param tpd_key: tpd key of the data
+        :param signature: current signature of the feature list
+        :param feats: features
+        """
+        import h5py
+        if feats.size == 0:
+            return
+        cache_file = self._get_cache_file_name()
+        self._files.discard(cache_file)
+        rows = max(1, min(feats.shape[0], 2**20 // (feats.shape[1] * feats.itemsize)))
+        tmp_key = tpd_key + "_tmp"
+        try:
+            with h5py.File(cache_file, "a") as f:
+                self._record_io(cache_file, bytes_written=feats.nbytes, file_opens=1)
+                if tmp_key in f.keys():
+                    del f[tmp_key]
+                dset = f.create_dataset(tmp_key, data=feats, chunks=(rows, feats.shape[1]),
+                                        compression="gzip", compression_opts=1, shuffle=True)
+                dset.attrs["signature"] = signature
+                if tpd_key in f.keys():
+                    del f[tpd_key]
+                f.move(tmp_key, tpd_key)
+        except (IOError, OSError):
+            pass
+
+    @_instrumented
+    def _get_feature_data(self, tpd_key, tpd_shape, dtype=numpy.float64, workers=1, cache=False,
+                          rows=None, features=None, mmap=False):
+        """Get the features of the desired data set.
+
+        If workers > 1, the feature files are read concurrently by a pool of
+        worker processes that write into disjoint columns of a shared memory
+        array.
+
+        If cache is True, the assembled features are stored in the .tpdcache
+        file next to the .tpd file and later calls read them from there. The
+        cache is rebuilt when the feature list or a feature file changes. The
+        cache is only used if all instances and features are selected.
+
+        If mmap is True, contiguous uncompressed feature data sets are read
+        through a memory map. If all features of a single feature file with the
+        given dtype are requested, the read-only numpy.memmap itself is returned.
+
+        Quantized features are converted back to the original range in a single
+        vectorized step after reading.
+
+        :param tpd_key: tpd key of the data
+        :param tpd_shape: tpd key of the shape of the raw data
+        :param dtype: dtype of the returned features
+        :param workers: number of processes that read the feature files
+        :param cache: use the feature cache
+        :param rows: selected instances (None, slice, index array or boolean mask)
+        :param features: selected features (None, slice, index array or boolean mask)
+        :param mmap: read contiguous data sets through a memory map
+        :return: features of the desired data set
+        """
+        feature_list, count, num_all_feats, infos = self._get_feature_layout(tpd_key, tpd_shape)
+        first_feats = numpy.cumsum([0] + num_all_feats[:-1]).tolist()
+        row_sel, num_rows, row_inverse = self._normalize_index(rows, count)
+        col_sel, num_cols, col_inverse = self._normalize_index(features, sum(num_all_feats))
+        shape = (num_rows, num_cols)
+        cache = cache and rows is None and features is None
+
+        # Get the selected features inside each feature file.
+        tasks = []
+        current_feat = 0
+        col_indices = None if features is None else self._selection_to_indices(col_sel)
+        for (file_path, h5_key), first_feat, num_feats in zip(feature_list, first_feats, num_all_feats):
+            if col_indices is None:
+                columns = None
+                num_selected = num_feats
+            else:
+                columns = col_indices[(col_indices >= first_feat) & (col_indices < first_feat+num_feats)] - first_feat
+                num_selected = len(columns)
+            if num_selected > 0:
+                tasks.append((file_path, h5_key, current_feat, num_feats, row_sel, columns))
+            current_feat += num_selected
+
+        if cache:
+            signature = self._get_feature_signature(feature_list, infos)
+            feats = self._read_feature_cache(tpd_key, signature, dtype)
+            if feats is not None:
+                return feats
+
+        dequantization = self._get_dequantization(infos, num_all_feats)
+        if mmap and not cache and len(feature_list) == 1 and rows is None and features is None and \
+                dequantization is None:
+            file_path, h5_key = feature_list[0]
+            with self._files.open(file_path) as f:
+                mm = self._get_memmap(file_path, f[h5_key])
+            if mm is not None and mm.dtype == numpy.dtype(dtype):
+                return mm.reshape(shape)
+
+        read_dtype = self._get_read_dtype(dtype, dequantization)
+        if workers > 1 and len(tasks) > 1 and not mmap:
+            import multiprocessing
+            size = int(self._get_count(shape))
+            buf = multiprocessing.RawArray("b", max(size * read_dtype.itemsize, 1))
+            feats = numpy.frombuffer(buf, dtype=read_dtype, count=size).reshape(shape)
+            pool = multiprocessing.Pool(min(workers, len(tasks)), _init_feature_worker,
+                                        (buf, shape, read_dtype, self.swmr))
+            try:
+                for file_path, nbytes in pool.imap_unordered(_read_feature_worker, tasks):
+                    self._record_io(file_path, bytes_read=nbytes, file_opens=1)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            # Read all features directly into a single numpy array.
+            feats = numpy.empty(shape, dtype=read_dtype)
+            for file_path, h5_key, current_feat, num_feats, rows_sel, columns in tasks:
+                with self._files.open(file_path) as f:
+                    mm = self._get_memmap(file_path, f[h5_key]) if mmap else None
+                    if mm is not None:
+                        nbytes = self._read_feature_mmap_into(mm, feats, current_feat, num_feats, rows_sel, columns)
+                    else:
+                        nbytes = self._read_feature_into(f[h5_key], feats, current_feat, num_feats, rows_sel, columns)
+                self._record_io(file_path, bytes_read=nbytes)
+        feats = self._dequantize(feats, dequantization, col_indices, dtype)
+
+        if cache:
+            self._write_feature_cache(tpd_key, signature, feats)
+        if row_inverse is not None:
+            feats = feats[row_inverse]
+        if col_inverse is not None:
+            feats = feats[:, col_inverse]
+        return feats
+
+    def _iter_feature_data(self, tpd_key, tpd_shape, batch_size, dtype=numpy.float64):
+        """
+        Iterate over the features of the desired data set in blocks of batch_size
+        instances. Only the current block is held in memory.
+
+        :param tpd_key: tpd key of the data
+        :param tpd_shape: tpd key of the shape of the raw data
+        :param batch_size: number of instances per block
+        :param dtype: dtype of the returned features
+        :return: generator of (batch_size, d) numpy arrays (the last block may be smaller)
+        """
+        if batch_size <= 0:
+            raise TPDError("_iter_feature_data(): The batch size must be positive.")
+        feature_list, count, num_all_feats, infos = self._get_feature_layout(tpd_key, tpd_shape)
+        dequantization = self._get_dequantization(infos, num_all_feats)
+        read_dtype = self._get_read_dtype(dtype, dequantization)
+
+        # Keep the feature files open while iterating.
+        files = []
+        try:
+            dsets = []
+            for file_path, h5_key in feature_list:
+                f = self._files.acquire(file_path)
+                files.append(file_path)
+                dsets.append(f[h5_key])
+
+            for start in xrange(0, count, batch_size):
+                stop = min(start + batch_size, count)
+                feats = numpy.empty((stop-start, sum(num_all_feats)), dtype=read_dtype)
+                current_feat = 0
+                for file_path, dset, num_feats in zip(files, dsets, num_all_feats):
+                    nbytes = self._read_feature_into(dset, feats, current_feat, num_feats, [(start, stop)])
+                    self._record_io(file_path, bytes_read=nbytes)
+                    current_feat += num_feats
+                yield self._dequantize(feats, dequantization, dtype=dtype)
+        finally:
+            for file_path in files:
+                self._files.release(file_path)
+
+    def get_train_features(self, dtype=numpy.float64, workers=1, cache=False, rows=None, features=None,
+                           mmap=False):
         """Return a (n, d) numpy array with the training features (n instances, d features).
 
+        Only the selected instances and features are read from the feature files.
+
+        :param dtype: dtype of the returned features
+        :param workers: number of processes that read the feature files
+        :param cache: use the feature cache in the .tpdcache file
+        :param rows: selected instances (None, slice, index array or boolean mask)
+        :param features: selected features (None, slice, index array or boolean mask)
+        :param mmap: read contiguous data sets through a memory map (see _get_feature_data)
         :return: training features
         """
-        return self._get_feature_data(self._tpd_train_feat, self._tpd_train_shape)
+        return self._get_feature_data(self._tpd_train_feat, self._tpd_train_shape, dtype, workers, cache,
+                                      rows, features, mmap)
 
-    def get_test_features(self):
+    def get_test_features(self, dtype=numpy.float64, workers=1, cache=False, rows=None, features=None,
+                           mmap=False):
         """Return a (n, d) numpy array with the test features (n instances, d features).
 
+        Only the selected instances and features are read from the feature files.
+
+        :param dtype: dtype of the returned features
+        :param workers: number of processes that read the feature files
+        :param cache: use the feature cache in the .tpdcache file
+        :param rows: selected instances (None, slice, index array or boolean mask)
+        :param features: selected features (None, slice, index array or boolean mask)
+        :param mmap: read contiguous data sets through a memory map (see _get_feature_data)
         :return: test features
         """
-        return self._get_feature_data(self._tpd_test_feat, self._tpd_test_shape)
+        return self._get_feature_data(self._tpd_test_feat, self._tpd_test_shape, dtype, workers, cache,
+                                      rows, features, mmap)
+
+    @property
+    def train_features(self):
+        """Return a lazy FeatureMatrix view of the training features.
+
+        :return: training features
+        """
+        return FeatureMatrix(self, self._tpd_train_feat, self._tpd_train_shape)
+
+    @property
+    def test_features(self):
+        """Return a lazy FeatureMatrix view of the test features.
+
+        :return: test features
+        """
+        return FeatureMatrix(self, self._tpd_test_feat, self._tpd_test_shape)
+
+    def iter_train_features(self, batch_size, dtype=numpy.float64):
+        """Iterate over the training features in (batch_size, d) blocks.
+
+        :param batch_size: number of instances per block
+        :param dtype: dtype of the returned features
+        :return: generator of training feature blocks
+        """
+        return self._iter_feature_data(self._tpd_train_feat, self._tpd_train_shape, batch_size, dtype)
+
+    def iter_test_features(self, batch_size, dtype=numpy.float64):
+        """Iterate over the test features in (batch_size, d) blocks.
+
+        :param batch_size: number of instances per block
+        :param dtype: dtype of the returned features
+        :return: generator of test feature blocks
+        """
+        return self._iter_feature_data(self._tpd_test_feat, self._tpd_test_shape, batch_size, dtype)
+
+    def _export_feature_vds(self, tpd_key, tpd_shape, file_name, h5_key, dtype=numpy.float64):
+        """
+        Create an HDF5 virtual data set with the (n, d) feature matrix, that maps
+        the columns to the feature files without copying the data. The source
+        file names are relative to the new file (absolute if use_abs_paths is set).
+
+        :param tpd_key: tpd key of the data
+        :param tpd_shape: tpd key of the shape of the raw data
+        :param file_name: file name of the virtual data set
+        :param h5_key: h5 key of the virtual data set
+        :param dtype: dtype of the virtual data set (the features are converted while reading)
+        """
+        import h5py
+        if not hasattr(h5py, "VirtualLayout"):
+            raise TPDError("_export_feature_vds(): Virtual data sets require h5py 2.9 or newer.")
+        feature_list, count, num_all_feats, infos = self._get_feature_layout(tpd_key, tpd_shape)
+        if self._get_dequantization(infos, num_all_feats) is not None:
+            raise TPDError("_export_feature_vds(): Quantized features cannot be mapped into a virtual data set.")
+        out_dir = os.path.dirname(os.path.abspath(file_name))
+        layout = h5py.VirtualLayout(shape=(count, sum(num_all_feats)), dtype=dtype)
+        current_feat = 0
+        for (file_path, h5_key_src), num_feats, info in zip(feature_list, num_all_feats, infos):
+            if self.use_abs_paths:
+                path = os.path.abspath(file_path)
+            else:
+                path = os.path.relpath(file_path, start=out_dir)
+            shape = tuple(info["shape"])
+            source = h5py.VirtualSource(path, h5_key_src, shape=shape, dtype=info["dtype"])
+            if num_feats == 1:
+                layout[:, current_feat] = source
+            elif len(shape) == 2:
+                layout[:, current_feat:current_feat+num_feats] = source
+            else:
+                # Map each feature of a multi-dimensional data set separately.
+                for j in xrange(num_feats):
+                    index = tuple(int(i) for i in numpy.unravel_index(j, shape[1:]))
+                    layout[:, current_feat+j] = source[(slice(None),) + index]
+            current_feat += num_feats
+
+        self._files.discard(file_name)
+        with h5py.File(file_name, "a") as f:
+            self._record_io(file_name, file_opens=1)
+            if h5_key in f.keys():
+                del f[h5_key]
+            f.create_virtual_dataset(h5_key, layout)
+
+    def export_train_feature_vds(self, file_name, h5_key, dtype=numpy.float64):
+        """Create an HDF5 virtual data set with the training features (see _export_feature_vds).
+
+        :param file_name: file name of the virtual data set
+        :param h5_key: h5 key of the virtual data set
+        :param dtype: dtype of the virtual data set
+        """
+        self._export_feature_vds(self._tpd_train_feat, self._tpd_train_shape, file_name, h5_key, dtype)
+
+    def export_test_feature_vds(self, file_name, h5_key, dtype=numpy.float64):
+        """Create an HDF5 virtual data set with the test features (see _export_feature_vds).
+
+        :param file_name: file name of the virtual data set
+        :param h5_key: h5 key of the virtual data set
+        :param dtype: dtype of the virtual data set
+        """
+        self._export_feature_vds(self._tpd_test_feat, self._tpd_test_shape, file_name, h5_key, dtype)
+
+    def _iter_minibatches(self, tpd_key, tpd_shape, batch_size, shuffle=True, seed=None, prefetch=2,
+                          dtype=numpy.float64, gt=None, buffer_blocks=8):
+        """
+        Iterate over the features in minibatches.
+
+        The instances are split into blocks whose size is the least common
+        multiple of the chunk sizes (in instances) of the feature files and the
+        gt data set, so every block covers whole chunks of each file. If the
+        least common multiple is too large, the largest chunk size is used. If
+        shuffle is True, the blocks are visited in random
+        order, buffer_blocks blocks are read at once and the instances inside this
+        buffer are shuffled. So each chunk is read only once per epoch, while the
+        batches are still well mixed. The buffers are read in a background thread
+        that keeps the next prefetch buffers ready.
+
+        :param tpd_key: tpd key of the data
+        :param tpd_shape: tpd key of the shape of the raw data
+        :param batch_size: number of instances per batch
+        :param shuffle: shuffle the instances
+        :param seed: seed of the random generator
+        :param prefetch: number of buffers that are read in advance (0: no background thread)
+        :param dtype: dtype of the returned features
+        :param gt: None or (tpd key of the gt file name, tpd key of the gt h5 key)
+        :param buffer_blocks: number of blocks that are shuffled together
+        :return: generator of (batch_size, d) numpy arrays or (features, labels) tuples (the last batch may be smaller)
+        """
+        if batch_size <= 0 or buffer_blocks <= 0:
+            raise TPDError("_iter_minibatches(): The batch size and the buffer size must be positive.")
+        feature_list, count, num_all_feats, infos = self._get_feature_layout(tpd_key, tpd_shape)
+        sources = list(feature_list)
+        num_all_feats = list(num_all_feats)
+        if gt is not None:
+            gt_file, gt_key = self._get_data(*gt)
+            self._check_file_exists(gt_file)
+            sources.append([gt_file, gt_key])
+
+        dequantization = self._get_dequantization(infos, num_all_feats)
+        read_dtype = self._get_read_dtype(dtype, dequantization)
+        rng = numpy.random.RandomState(seed)
+
+        # Keep the files open while iterating.
+        files = []
+        try:
+            dsets = []
+            for file_path, h5_key in sources:
+                f = self._files.acquire(file_path)
+                files.append(file_path)
+                dsets.append(f[h5_key])
+
+            # Use blocks that cover whole chunks of every feature file and the gt data.
+            chunk_rows = [dset.chunks[0] * self._get_count(dset.shape[1:]) // num_feats
+                          for dset, num_feats in zip(dsets, num_all_feats + [1]) if dset.chunks is not None]
+            row_bytes = max(sum(num_all_feats) * read_dtype.itemsize, 1)
+            block_rows = self._get_block_rows(chunk_rows, self._max_covering_bytes // row_bytes)
+            block_starts = numpy.arange(0, count, block_rows)
+            if shuffle:
+                rng.shuffle(block_starts)
+            gt_dset = dsets.pop() if gt is not None else None
+
+            def read_buffers():
+                for i in xrange(0, len(block_starts), buffer_blocks):
+                    runs = [(int(start), int(min(start + block_rows, count)))
+                            for start in sorted(block_starts[i:i+buffer_blocks])]
+                    num_rows = sum(stop-start for start, stop in runs)
+                    feats = numpy.empty((num_rows, sum(num_all_feats)), dtype=read_dtype)
+                    current_feat = 0
+                    for file_path, dset, num_feats in zip(files, dsets, num_all_feats):
+                        nbytes = self._read_feature_into(dset, feats, current_feat, num_feats, runs)
+                        self._record_io(file_path, bytes_read=nbytes)
+                        current_feat += num_feats
+                    feats = self._dequantize(feats, dequantization, dtype=dtype)
+                    labels = None
+                    if gt_dset is not None:
+                        labels = numpy.empty((num_rows, 1), dtype=gt_dset.dtype)
+                        nbytes = self._read_feature_into(gt_dset, labels, 0, 1, runs)
+                        self._record_io(files[-1], bytes_read=nbytes)
+                        labels = labels.reshape(-1)
+                    if shuffle:
+                        order = rng.permutation(num_rows)
+                        feats = feats[order]
+                        if labels is not None:
+                            labels = labels[order]
+                    yield feats, labels
+
+            # Carry the remaining instances of a buffer over to the next one, so
+            # only the last batch is smaller than batch_size.
+            rest_feats = None
+            rest_labels = None
+            for feats, labels in _prefetch(read_buffers(), prefetch):
+                if rest_feats is not None:
+                    feats = numpy.concatenate((rest_feats, feats))
+                    if labels is not None:
+                        labels = numpy.concatenate((rest_labels, labels))
+                num_full = len(feats) - len(feats) % batch_size
+                for start in xrange(0, num_full, batch_size):
+                    if labels is None:
+                        yield feats[start:start+batch_size]
+                    else:
+                        yield feats[start:start+batch_size], labels[start:start+batch_size]
+                rest_feats = feats[num_full:]
+                rest_labels = labels[num_full:] if labels is not None else None
+            if rest_feats is not None and len(rest_feats) > 0:
+                if rest_labels is None:
+                    yield rest_feats
+                else:
+                    yield rest_feats, rest_labels
+        finally:
+            for file_path in files:
+                self._files.release(file_path)
+
+    @staticmethod
+    def _get_block_rows(chunk_rows, max_rows):
+        """
+        Return the least common multiple of the given chunk sizes, or the
+        largest chunk size if the least common multiple exceeds max_rows.
+
+        :param chunk_rows: list with the number of instances per chunk of each data set
+        :param max_rows: maximum number of instances per block
+        :return: number of instances per block
+        """
+        block_rows = 1
+        for rows in chunk_rows:
+            a, b = block_rows, int(rows)
+            while b > 0:
+                a, b = b, a % b
+            block_rows = block_rows // a * int(rows)
+            if block_rows > max_rows:
+                return max(1, max(int(rows) for rows in chunk_rows))
+        return max(1, block_rows)
+
+    def minibatches(self, batch_size, shuffle=True, seed=None, prefetch=2, dtype=numpy.float64, gt=False,
+                    buffer_blocks=8):
+        """Iterate over the training features in (shuffled) minibatches (see _iter_minibatches).
+
+        :param batch_size: number of instances per batch
+        :param shuffle: shuffle the instances
+        :param seed: seed of the random generator
+        :param prefetch: number of buffers that are read in advance
+        :param dtype: dtype of the returned features
+        :param gt: also return the training gt of the instances
+        :param buffer_blocks: number of chunk-aligned blocks that are shuffled together
+        :return: generator of feature batches or (features, labels) tuples
+        """
+        gt_keys = (self._tpd_train_gt_path, self._tpd_train_gt_key) if gt else None
+        return self._iter_minibatches(self._tpd_train_feat, self._tpd_train_shape, batch_size, shuffle, seed,
+                                      prefetch, dtype, gt_keys, buffer_blocks)
+
+    def _compute_feature_stats(self, tpd_key, tpd_shape, bins=None):
+        """
+        Compute count, mean, std, min and max of each feature in a single
+        streaming pass over the feature files. If bins is given, the histograms
+        (with bins equal-width bins between min and max) are computed in a
+        second pass.
+
+        :param tpd_key: tpd key of the data
+        :param tpd_shape: tpd key of the shape of the raw data
+        :param bins: number of histogram bins
+        :return: dict with the statistics
+        """
+        _, count, num_all_feats, _ = self._get_feature_layout(tpd_key, tpd_shape)
+        d = sum(num_all_feats)
+        batch_size = max(1, 2**24 // (8 * max(d, 1)))
+
+        # Merge the moments of the batches (Chan et al.).
+        n = 0
+        mean = numpy.zeros(d)
+        m2 = numpy.zeros(d)
+        fmin = numpy.full(d, numpy.inf)
+        fmax = numpy.full(d, -numpy.inf)
+        for feats in self._iter_feature_data(tpd_key, tpd_shape, batch_size):
+            b = feats.shape[0]
+            b_mean = feats.mean(axis=0)
+            b_m2 = ((feats - b_mean)**2).sum(axis=0)
+            delta = b_mean - mean
+            mean += delta * b / float(n + b)
+            m2 += b_m2 + delta**2 * n * b / float(n + b)
+            n += b
+            numpy.minimum(fmin, feats.min(axis=0), out=fmin)
+            numpy.maximum(fmax, feats.max(axis=0), out=fmax)
+        stats = {"count": n, "mean": mean, "std": numpy.sqrt(m2 / max(n, 1)), "min": fmin, "max": fmax}
+
+        if bins is not None:
+            hist = numpy.zeros((d, bins), dtype=numpy.int64)
+            width = fmax - fmin
+            scale = numpy.where(width > 0, bins / numpy.where(width > 0, width, 1), 0)
+            offsets = numpy.arange(d) * bins
+            for feats in self._iter_feature_data(tpd_key, tpd_shape, batch_size):
+                idx = numpy.clip(((feats - fmin) * scale).astype(numpy.int64), 0, bins-1) + offsets
+                hist += numpy.bincount(idx.reshape(-1), minlength=d*bins).reshape(d, bins)
+            stats["hist"] = hist
+            stats["bin_edges"] = fmin[:, numpy.newaxis] + width[:, numpy.newaxis] * numpy.linspace(0, 1, bins+1)
+        return stats
+
+    def _read_tpd_group(self, group_key, signature, keys=None):
+        """Read the data sets of a group in the .tpd file, if the group exists and has the given signature.
+
+        :param group_key: key of the group
+        :param signature: expected signature
+        :param keys: keys of the data sets that are read (None: all)
+        :return: dict with the data sets or None
+        """
+        import h5py
+        if group_key in self._groups and self._groups[group_key][0] == signature:
+            # Return copies, so the arrays in memory cannot be changed by the caller.
+            values = self._groups[group_key][1]
+            return dict((key, numpy.copy(values[key])) for key in (values.keys() if keys is None else keys))
+        with h5py.File(self.file_name, "r") as f:
+            self._record_io(self.file_name, file_opens=1)
+            if group_key not in f.keys() or f[group_key].attrs.get("signature") != signature:
+                return None
+            g = f[group_key]
+            return dict((key, g[key].value) for key in (g.keys() if keys is None else keys))
+
+    def _read_tpd_group_entries(self, group_key, signature, key, positions):
+        """
+        Read the given entries of a 1D data set in a group of the .tpd file, if
+        the group exists and has the given signature.
+
+        :param group_key: key of the group
+        :param signature: expected signature
+        :param key: key of the data set
+        :param positions: sorted array of unique positions
+        :return: numpy array with the entries or None
+        """
+        import h5py
+        if group_key in self._groups and self._groups[group_key][0] == signature:
+            return self._groups[group_key][1][key][positions]
+        with h5py.File(self.file_name, "r") as f:
+            self._record_io(self.file_name, file_opens=1)
+            if group_key not in f.keys() or f[group_key].attrs.get("signature") != signature:
+                return None
+            dset = f[group_key][key]
+            sel, num, _ = self._normalize_index(positions, dset.shape[0])
+            entries = numpy.empty((num, 1), dtype=dset.dtype)
+            self._record_io(self.file_name, bytes_read=self._read_feature_into(dset, entries, 0, 1, sel))
+        return entries.reshape(-1)
+
+    def _write_tpd_group(self, group_key, signature, values):
+        """
+        Replace the group in the .tpd file with the given data sets and signature.
+        Nothing is written if the .tpd file is read-only or in SWMR mode, the
+        group is then only kept in memory.
+
+        :param group_key: key of the group
+        :param signature: signature
+        :param values: dict with the data sets
+        """
+        self._groups.pop(group_key, None)
+        if self.swmr:
+            self._groups[group_key] = (signature, dict((key, numpy.copy(value)) for key, value in values.items()))
+            return
+        try:
+            with self._edit_tpd() as f:
+                if group_key in f.keys():
+                    del f[group_key]
+                g = f.create_group(group_key)
+                for key, value in values.items():
+                    value = numpy.asarray(value)
+                    if value.ndim > 0 and value.size > 2**16:
+                        g.create_dataset(key, data=value, chunks=(2**16,) + value.shape[1:],
+                                         compression="gzip", compression_opts=1)
+                    else:
+                        g[key] = value
+                g.attrs["signature"] = signature
+        except (IOError, OSError):
+            self._groups[group_key] = (signature, dict((key, numpy.copy(value)) for key, value in values.items()))
+
+    def _get_feature_stats(self, tpd_key, tpd_shape, bins=None):
+        """
+        Return the statistics of each feature. The statistics are stored in the
+        .tpd file and only recomputed when the feature list or a feature file
+        changes (or when histograms with a different number of bins are requested).
+
+        :param tpd_key: tpd key of the data
+        :param tpd_shape: tpd key of the shape of the raw data
+        :param bins: number of histogram bins (None: no histograms)
+        :return: dict with count, mean, std, min, max (and hist, bin_edges)
+        """
+        feature_list, count, num_all_feats, infos = self._get_feature_layout(tpd_key, tpd_shape)
+        signature = self._get_feature_signature(feature_list, infos)
+        stats_key = tpd_key + self._tpd_stats_suffix
+        stats = self._read_tpd_group(stats_key, signature)
+        if stats is not None and (bins is None or ("hist" in stats and stats["hist"].shape[1] == bins)):
+            return stats
+
+        stats = self._compute_feature_stats(tpd_key, tpd_shape, bins)
+        self._write_tpd_group(stats_key, signature, stats)
+        return stats
+
+    def get_train_feature_stats(self, bins=None):
+        """Return count, mean, std, min and max (and histograms) of each training feature.
+
+        :param bins: number of histogram bins (None: no histograms)
+        :return: dict with the statistics
+        """
+        return self._get_feature_stats(self._tpd_train_feat, self._tpd_train_shape, bins)
+
+    def get_test_feature_stats(self, bins=None):
+        """Return count, mean, std, min and max (and histograms) of each test feature.
+
+        :param bins: number of histogram bins (None: no histograms)
+        :return: dict with the statistics
+        """
+        return self._get_feature_stats(self._tpd_test_feat, self._tpd_test_shape, bins)
+
+    def _compute_label_index(self, file_name, h5_key):
+        """
+        Compute the label index of the given gt data in a single pass over slabs
+        along the first axis (aligned to the chunks).
+
+        :param file_name: file name of the gt data
+        :param h5_key: h5 key of the gt data
+        :return: labels, offsets, indices (the flat indices of labels[i] are indices[offsets[i]:offsets[i+1]])
+        """
+        with self._files.open(file_name) as f:
+            dset = f[h5_key]
+            shape = dset.shape
+            dtype = dset.dtype
+        index_dtype = self._get_index_dtype(self._get_count(shape))
+        if len(shape) == 0 or self._get_count(shape) == 0:
+            return numpy.zeros(0, dtype=dtype), numpy.zeros(1, dtype=numpy.int64), numpy.zeros(0, dtype=index_dtype)
+        inner = self._get_count(shape[1:])
+        slab_rows = max(1, 2**24 // max(inner * dtype.itemsize, 1))
+
+        parts = {}
+        for block in self._iter_data_blocks(file_name, h5_key, (slab_rows,) + tuple(shape[1:])):
+            labels = block.data.reshape(-1)
+            order = numpy.argsort(labels, kind="mergesort")
+            block_labels, starts = numpy.unique(labels[order], return_index=True)
+            stops = numpy.append(starts[1:], len(order))
+            order = (order + block.begin[0] * inner).astype(index_dtype)
+            for label, start, stop in zip(block_labels, starts, stops):
+                parts.setdefault(label, []).append(order[start:stop])
+
+        labels = numpy.array(sorted(parts.keys()), dtype=dtype)
+        counts = [sum(len(p) for p in parts[label]) for label in labels]
+        offsets = numpy.concatenate(([0], numpy.cumsum(counts))).astype(numpy.int64)
+        indices = numpy.concatenate([numpy.concatenate(parts[label]) for label in labels]).astype(index_dtype)
+        return labels, offsets, indices
+
+    @staticmethod
+    def _get_index_dtype(count):
+        """Return the dtype of the label index entries for the given number of instances.
+
+        :param count: number of instances
+        :return: numpy.uint32 if all flat indices fit, else numpy.int64
+        """
+        return numpy.dtype(numpy.uint32) if count < 2**32 else numpy.dtype(numpy.int64)
+
+    @staticmethod
+    def _get_label_index_signature(file_name, h5_key):
+        """Return a string that changes whenever the given gt data set changes.
+
+        :param file_name: file name of the gt data
+        :param h5_key: h5 key of the gt data
+        :return: signature
+        """
+        mtime, size = _get_file_stat(file_name)
+        return hashlib.sha1(json.dumps([os.path.abspath(file_name), h5_key, mtime, size])
+                            .encode("utf-8")).hexdigest()
+
+    def _get_label_index(self, tpd_path, tpd_key, positions=None):
+        """
+        Return the label index of the given gt data. The index is stored in the
+        .tpd file and only recomputed if the gt file changes.
+
+        If positions is given, only these entries of indices are read, so the
+        whole index is not loaded into memory.
+
+        :param tpd_path: tpd key of the gt file name
+        :param tpd_key: tpd key of the gt h5 key
+        :param positions: None (all entries) or function that maps labels and offsets to sorted unique positions
+        :return: labels, offsets, indices (the flat indices of labels[i] are indices[offsets[i]:offsets[i+1]],
+                 or the entries at the given positions)
+        """
+        file_name, h5_key = self._get_data(tpd_path, tpd_key)
+        self._check_file_exists(file_name)
+        signature = self._get_label_index_signature(file_name, h5_key)
+        index_key = tpd_path + self._tpd_index_suffix
+        if positions is None:
+            index = self._read_tpd_group(index_key, signature)
+            if index is not None:
+                return index["labels"], index["offsets"], index["indices"]
+        else:
+            index = self._read_tpd_group(index_key, signature, ["labels", "offsets"])
+            if index is not None:
+                pos = positions(index["labels"], index["offsets"])
+                entries = self._read_tpd_group_entries(index_key, signature, "indices", pos)
+                if entries is not None:
+                    return index["labels"], index["offsets"], entries
+
+        labels, offsets, indices = self._compute_label_index(file_name, h5_key)
+        self._write_tpd_group(index_key, signature, {"labels": labels, "offsets": offsets, "indices": indices})
+        if positions is not None:
+            indices = indices[positions(labels, offsets)]
+        return labels, offsets, indices
+
+    def get_train_label_index(self):
+        """
+        Return the label index of the training gt data: For each label, the flat
+        indices of the instances with this label.
+
+        :return: labels, offsets, indices (the flat indices of labels[i] are indices[offsets[i]:offsets[i+1]])
+        """
+        return self._get_label_index(self._tpd_train_gt_path, self._tpd_train_gt_key)
+
+    @staticmethod
+    def _sample_positions(rng, n, k):
+        """
+        Draw min(k, n) distinct positions in [0, n) uniformly at random. Small
+        samples are drawn without a permutation of all n positions.
+
+        :param rng: numpy.random.RandomState
+        :param n: number of positions
+        :param k: number of drawn positions
+        :return: sorted array of positions
+        """
+        if k >= n:
+            return numpy.arange(n, dtype=numpy.int64)
+        if 2*k > n:
+            return numpy.sort(rng.permutation(n)[:k]).astype(numpy.int64)
+        pos = numpy.unique(rng.randint(0, n, k))
+        while len(pos) < k:
+            pos = numpy.unique(numpy.concatenate((pos, rng.randint(0, n, k-len(pos)))))
+        return pos.astype(numpy.int64)
+
+    def sample_train(self, n_per_class, seed=None, dtype=numpy.float64):
+        """
+        Draw a class-balanced random sample (without replacement) of the training
+        instances and return its features and labels. Only the sampled instances
+        are read. Classes with less than n_per_class instances are taken completely.
+
+        :param n_per_class: number of instances per class
+        :param seed: seed of the random generator
+        :param dtype: dtype of the features
+        :return: features, labels, flat indices of the sampled instances (sorted)
+        """
+        rng = numpy.random.RandomState(seed)
+
+        # Draw positions in the label index, so only the sampled entries are read.
+        def positions(labels, offsets):
+            pos = [offsets[i] + self._sample_positions(rng, offsets[i+1]-offsets[i], n_per_class)
+                   for i in xrange(len(labels))]
+            return numpy.sort(numpy.concatenate(pos)) if len(pos) > 0 else numpy.zeros(0, dtype=numpy.int64)
+
+        _, _, rows = self._get_label_index(self._tpd_train_gt_path, self._tpd_train_gt_key, positions)
+        rows = numpy.sort(rows).astype(numpy.int64)
+        feats = self.get_train_features(dtype=dtype, rows=rows)
+        gt = self.get_train_gt_data(rows=rows)
+        return feats, gt, rows
+
+    def _append_instances(self, tpd_feat, tpd_shape, tpd_raw, tpd_gt, raw=None, gt=None, features=None):
+        """
+        Append instances to the raw, gt and feature data sets. The data sets
+        are resized along the first axis (they must be chunked with unlimited
+        maximum shape, e.g. written by repack_tpd_file.py). Every data set that
+        is referenced in the .tpd file must be given. The first axis of the new
+        arrays is appended to the first axis of the data sets, so the new
+        instances come after the old ones.
+
+        The shape in the .tpd file is updated. The stored feature statistics and
+        the label index are updated with the new instances (histograms are
+        dropped), the feature cache is rebuilt on its next use. Predictions are
+        not extended. The new data of quantized features is quantized with the
+        stored scale and offset, it must lie in the range of the stored data type.
+        A data set that is referenced more than once is appended once, the new
+        data must then be identical.
+
+        :param tpd_feat: tpd key of the feature list
+        :param tpd_shape: tpd key of the shape of the data
+        :param tpd_raw: (tpd key of the raw file name, tpd key of the raw h5 key)
+        :param tpd_gt: (tpd key of the gt file name, tpd key of the gt h5 key)
+        :param raw: new raw data
+        :param gt: new gt data
+        :param features: list with the new data of each feature in the feature list
+        """
+        import h5py
+        manifest = self._get_manifest()
+        if tpd_shape not in manifest:
+            raise TPDError("_append_instances(): The .tpd file does not contain the shape of the data.")
+        shape = tuple(int(s) for s in manifest[tpd_shape])
+        count = self._get_count(shape)
+        inner = self._get_count(shape[1:])
+
+        # Collect the data sets with the new data.
+        targets = []
+        for (tpd_path, tpd_key), data, name in [(tpd_raw, raw, "raw"), (tpd_gt, gt, "gt")]:
+            if tpd_path in manifest:
+                if data is None:
+                    raise TPDError("_append_instances(): The new %s data is missing." % name)
+                targets.append(self._get_data(tpd_path, tpd_key) + (numpy.asarray(data), None))
+        if raw is None and gt is None and features is None:
+            raise TPDError("_append_instances(): There is no data to append.")
+        for data in [raw, gt]:
+            if data is not None:
+                data = numpy.asarray(data)
+                if data.ndim != len(shape) or data.shape[1:] != shape[1:]:
+                    raise TPDError("_append_instances(): The shape of the new data does not match.")
+        new_count = targets[0][2].shape[0] * inner if len(targets) > 0 else None
+        old_stats = None
+        if tpd_feat in manifest:
+            feature_list, _, num_all_feats, infos = self._get_feature_layout(tpd_feat, tpd_shape)
+            if features is None or len(features) != len(feature_list):
+                raise TPDError("_append_instances(): The new data of each feature must be given.")
+            old_signature = self._get_feature_signature(feature_list, infos)
+            old_stats = self._read_tpd_group(tpd_feat + self._tpd_stats_suffix, old_signature)
+            for (file_path, h5_key), num_feats, info, data in zip(feature_list, num_all_feats, infos, features):
+                data = numpy.asarray(data)
+                if new_count is None:
+                    new_count = data.size // num_feats
+                if data.size != new_count * num_feats:
+                    raise TPDError("_append_instances(): The numbers of new instances do not match.")
+                targets.append((file_path, h5_key, data, info))
+        elif features is not None and len(features) > 0:
+            raise TPDError("_append_instances(): There are no features in the .tpd file.")
+        if new_count is None or new_count % inner != 0:
+            raise TPDError("_append_instances(): The numbers of new instances do not match.")
+
+        old_index = None
+        if tpd_gt[0] in manifest:
+            gt_file, gt_key = self._get_data(*tpd_gt)
+            index = self._read_tpd_group(tpd_gt[0] + self._tpd_index_suffix,
+                                         self._get_label_index_signature(gt_file, gt_key))
+            if index is not None:
+                old_index = index["labels"], index["offsets"], index["indices"]
+
+        # Check the data sets before anything is written. The new data of
+        # quantized features is quantized with the stored scale and offset.
+        for i, (file_path, h5_key, data, info) in enumerate(targets):
+            if not os.access(file_path, os.W_OK):
+                raise TPDError("_append_instances(): The file %s is not writable." % file_path)
+            with self._files.open(file_path, keep=False) as f:
+                dset = f[h5_key]
+                if dset.maxshape[0] is not None:
+                    raise TPDError("_append_instances(): The data set %s in %s is not resizable." %
+                                   (h5_key, file_path))
+                if data.ndim != dset.ndim or data.shape[1:] != dset.shape[1:]:
+                    raise TPDError("_append_instances(): The shape of the new data does not match.")
+            if info is not None and "scale" in info:
+                num_feats = len(info["scale"])
+                scale = numpy.array(info["scale"])
+                offset = numpy.array(info["offset"])
+                codes = numpy.rint((data.reshape(-1, num_feats) - offset) / scale)
+                if not ((codes >= 0) & (codes <= numpy.iinfo(numpy.dtype(info["dtype"])).max)).all():
+                    raise TPDError("_append_instances(): The new data of the quantized feature %s in %s is out "
+                                   "of the quantization range." % (h5_key, file_path))
+                targets[i] = (file_path, h5_key, codes.reshape(data.shape), info)
+
+        # A data set that is referenced more than once (e.g. raw data that is
+        # also a feature) is only appended once, with identical new data.
+        writes = collections.OrderedDict()
+        for file_path, h5_key, data, info in targets:
+            target_key = (os.path.realpath(file_path), h5_key)
+            if target_key in writes:
+                if not numpy.array_equal(writes[target_key][2], data):
+                    raise TPDError("_append_instances(): The data set %s in %s is referenced more than once with "
+                                   "different new data." % (h5_key, file_path))
+                continue
+            writes[target_key] = (file_path, h5_key, data)
+
+        # Append the new data.
+        for file_path, h5_key, data in writes.values():
+            self._files.discard(file_path)
+            with h5py.File(file_path, "a") as f:
+                self._record_io(file_path, file_opens=1)
+                dset = f[h5_key]
+                old_len = dset.shape[0]
+                dset.resize(old_len + data.shape[0], axis=0)
+                dset[old_len:] = data
+                self._record_io(file_path, bytes_written=data.shape[0] * dset.dtype.itemsize *
+                                self._get_count(dset.shape[1:]))
+
+        # Store the new shape together with the infos of the changed feature
+        # files, so they are not probed again.
+        new_feats = []
+        new_infos = []
+        for file_path, h5_key, data, info in targets:
+            if info is not None:
+                stored = numpy.asarray(data, dtype=numpy.dtype(info["dtype"])).astype(numpy.float64)
+                new_feats.append(stored.reshape(new_count, -1))
+                with self._files.open(file_path, keep=False) as f:
+                    new_infos.append(self._get_feature_info(file_path, f[h5_key]))
+        new_shape = (shape[0] + new_count // inner,) + shape[1:]
+        values = {tpd_shape: new_shape}
+        if len(new_infos) > 0:
+            values[tpd_feat + self._tpd_info_suffix] = self._to_info_array(new_infos)
+        self._write_manifest(values)
+
+        # Update the feature statistics.
+        if old_stats is not None and new_count > 0:
+            feature_list, _, num_all_feats, infos = self._get_feature_layout(tpd_feat, tpd_shape)
+            feats = numpy.concatenate(new_feats, axis=1)
+            feats = self._dequantize(feats, self._get_dequantization(infos, num_all_feats))
+            n = int(old_stats["count"])
+            b = feats.shape[0]
+            b_mean = feats.mean(axis=0)
+            delta = b_mean - old_stats["mean"]
+            m2 = old_stats["std"]**2 * n + ((feats - b_mean)**2).sum(axis=0) + delta**2 * n * b / float(n + b)
+            stats = {"count": n + b,
+                     "mean": old_stats["mean"] + delta * b / float(n + b),
+                     "std": numpy.sqrt(m2 / (n + b)),
+                     "min": numpy.minimum(old_stats["min"], feats.min(axis=0)),
+                     "max": numpy.maximum(old_stats["max"], feats.max(axis=0))}
+            self._write_tpd_group(tpd_feat + self._tpd_stats_suffix,
+                                  self._get_feature_signature(feature_list, infos), stats)
+
+        # Update the label index.
+        if old_index is not None and new_count > 0:
+            labels, offsets, indices = old_index
+            parts = dict((label, [indices[offsets[i]:offsets[i+1]]]) for i, label in enumerate(labels))
+            new_labels = numpy.asarray(gt).reshape(-1)
+            order = numpy.argsort(new_labels, kind="mergesort")
+            block_labels, starts = numpy.unique(new_labels[order], return_index=True)
+            stops = numpy.append(starts[1:], len(order))
+            for label, start, stop in zip(block_labels, starts, stops):
+                parts.setdefault(label, []).append(order[start:stop] + count)
+            all_labels = numpy.array(sorted(parts.keys()), dtype=labels.dtype)
+            counts = [sum(len(p) for p in parts[label]) for label in all_labels]
+            offsets = numpy.concatenate(([0], numpy.cumsum(counts))).astype(numpy.int64)
+            indices = numpy.concatenate([numpy.concatenate(parts[label]) for label in all_labels]).astype(
+                self._get_index_dtype(self._get_count(new_shape)))
+            gt_file, gt_key = self._get_data(*tpd_gt)
+            self._write_tpd_group(tpd_gt[0] + self._tpd_index_suffix, self._get_label_index_signature(gt_file, gt_key),
+                                  {"labels": all_labels, "offsets": offsets, "indices": indices})
+
+    def append_train_instances(self, raw=None, gt=None, features=None):
+        """Append training instances to the referenced data sets (see _append_instances).
+
+        :param raw: new raw data
+        :param gt: new gt data
+        :param features: list with the new data of each training feature
+        """
+        self._append_instances(self._tpd_train_feat, self._tpd_train_shape,
+                               (self._tpd_train_raw_path, self._tpd_train_raw_key),
+                               (self._tpd_train_gt_path, self._tpd_train_gt_key), raw, gt, features)
+
+    def append_test_instances(self, raw=None, gt=None, features=None):
+        """Append test instances to the referenced data sets (see _append_instances).
+
+        :param raw: new raw data
+        :param gt: new gt data
+        :param features: list with the new data of each test feature
+        """
+        self._append_instances(self._tpd_test_feat, self._tpd_test_shape,
+                               (self._tpd_test_raw_path, self._tpd_test_raw_key),
+                               (self._tpd_test_gt_path, self._tpd_test_gt_key), raw, gt, features)
 
     def _clear_features(self, tpd_key):
         """Clear the list with features.
         """
-        with h5py.File(self.file_name) as f:
-            if tpd_key in f.keys():
-                del f[tpd_key]
+        if tpd_key in self._get_manifest():
+            self._write_manifest({tpd_key: None, tpd_key + self._tpd_info_suffix: None})
 
     def clear_train_features(self):
         """Clear the list with training features.
@@ -451,13 +2809,27 @@ class TrainPredictData(object):
         """
         return self._get_data(self._tpd_train_pred_path, self._tpd_train_pred_key)
 
-    def get_train_pred_data(self):
+    @_instrumented
+    def get_train_pred_data(self, rows=None, mmap=False):
         """Return the training prediction data.
 
+        :param rows: if given, only the selected instances are read and returned as 1D array
+        :param mmap: return a read-only numpy.memmap if the data set is contiguous and uncompressed
         :return: training prediction data
         """
         file_name, h5_key = self.get_train_pred()
-        return vigra.readHDF5(file_name, h5_key)
+        return self._read_data(file_name, h5_key, rows, mmap)
+
+    def iter_train_pred_blocks(self, block_shape, halo=0, prefetch=1):
+        """Iterate over blocks of the training prediction data (see _iter_data_blocks).
+
+        :param block_shape: shape of the blocks (int or tuple)
+        :param halo: number of additional voxels on each side of a block (int or tuple)
+        :param prefetch: number of blocks that are read in advance
+        :return: generator of Block
+        """
+        file_name, h5_key = self.get_train_pred()
+        return self._iter_data_blocks(file_name, h5_key, block_shape, halo, prefetch)
 
     def set_test_pred(self, file_name, h5_key):
         """Set file name and h5 key of the test prediction data.
@@ -476,13 +2848,169 @@ class TrainPredictData(object):
         """
         return self._get_data(self._tpd_test_pred_path, self._tpd_test_pred_key)
 
-    def get_test_pred_data(self):
+    @_instrumented
+    def get_test_pred_data(self, rows=None, mmap=False):
         """Return the test prediction data.
 
+        :param rows: if given, only the selected instances are read and returned as 1D array
+        :param mmap: return a read-only numpy.memmap if the data set is contiguous and uncompressed
         :return: test prediction data
         """
         file_name, h5_key = self.get_test_pred()
-        return vigra.readHDF5(file_name, h5_key)
+        return self._read_data(file_name, h5_key, rows, mmap)
+
+    def iter_test_pred_blocks(self, block_shape, halo=0, prefetch=1):
+        """Iterate over blocks of the test prediction data (see _iter_data_blocks).
+
+        :param block_shape: shape of the blocks (int or tuple)
+        :param halo: number of additional voxels on each side of a block (int or tuple)
+        :param prefetch: number of blocks that are read in advance
+        :return: generator of Block
+        """
+        file_name, h5_key = self.get_test_pred()
+        return self._iter_data_blocks(file_name, h5_key, block_shape, halo, prefetch)
+
+    @staticmethod
+    def _iter_predictions(batches, predict_fn, pool=None, max_pending=1):
+        """
+        Apply predict_fn to each batch and yield the results in order. If a
+        process pool is given, up to max_pending batches are processed at the
+        same time.
+
+        :param batches: iterable with feature batches
+        :param predict_fn: function that maps a (b, d) feature batch to b predictions
+        :param pool: multiprocessing pool or None
+        :param max_pending: maximum number of batches in the pool
+        :return: generator of (number of instances in the batch, predictions)
+        """
+        if pool is None:
+            for batch in batches:
+                yield batch.shape[0], predict_fn(batch)
+            return
+        pending = collections.deque()
+        for batch in batches:
+            pending.append((batch.shape[0], pool.apply_async(predict_fn, (batch,))))
+            if len(pending) >= max_pending:
+                num_rows, result = pending.popleft()
+                yield num_rows, result.get()
+        while len(pending) > 0:
+            num_rows, result = pending.popleft()
+            yield num_rows, result.get()
+
+    def _predict_to(self, tpd_key, tpd_shape, tpd_pred_path, tpd_pred_key, file_name, h5_key, predict_fn,
+                    batch_size, workers=1, dtype=numpy.float64, compression=None):
+        """
+        Stream the features in batches through predict_fn and write the
+        predictions into a chunked data set. The data set is then set as
+        prediction data of the .tpd file. In SWMR mode, it is set as soon as
+        it is created, so readers see the predictions while they are written.
+
+        :param tpd_key: tpd key of the feature list
+        :param tpd_shape: tpd key of the shape of the raw data
+        :param tpd_pred_path: tpd key of the prediction file
+        :param tpd_pred_key: tpd key of the prediction h5 key
+        :param file_name: output file name
+        :param h5_key: output h5 key
+        :param predict_fn: function that maps a (b, d) feature batch to b predictions (must be picklable if workers > 1)
+        :param batch_size: number of instances per batch
+        :param workers: number of processes that run predict_fn
+        :param dtype: dtype of the features that are passed to predict_fn
+        :param compression: compression of the output data set (e.g. "gzip")
+        """
+        import h5py
+        _, count, _, _ = self._get_feature_layout(tpd_key, tpd_shape)
+        kwargs = {"libver": "latest"} if self.swmr else {}
+        if tpd_shape not in self._get_manifest():
+            self._write_manifest({tpd_shape: (count,)})
+
+        # Start the worker processes before any background thread is running. The
+        # output file is closed before, so the workers do not inherit its lock.
+        self._files.discard(file_name)
+        pool = None
+        if workers > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(workers)
+        try:
+            with h5py.File(file_name, "a", **kwargs) as f:
+                if h5_key in f.keys():
+                    del f[h5_key]
+                dset = None
+                start = 0
+                batches = self._iter_feature_data(tpd_key, tpd_shape, batch_size, dtype)
+                for num_rows, pred in self._iter_predictions(batches, predict_fn, pool, 2*workers):
+                    pred = numpy.asarray(pred)
+                    if pred.ndim == 0 or pred.shape[0] != num_rows:
+                        raise TPDError("_predict_to(): predict_fn must return one prediction per instance.")
+                    if dset is None:
+                        # In SWMR mode, the data set grows with each batch and is
+                        # flushed, so readers see the predictions that are done.
+                        dset = f.create_dataset(h5_key, shape=(0 if self.swmr else count,) + pred.shape[1:],
+                                                maxshape=(count,) + pred.shape[1:], dtype=pred.dtype,
+                                                chunks=(min(batch_size, count),) + pred.shape[1:],
+                                                compression=compression)
+                        if self.swmr:
+                            try:
+                                f.swmr_mode = True
+                            except (RuntimeError, ValueError):
+                                raise TPDError("_predict_to(): SWMR writing requires an output file that was "
+                                               "created with libver='latest'.")
+                            self._write_manifest({tpd_pred_path: self._to_tpd_path(file_name),
+                                                  tpd_pred_key: h5_key})
+                    elif pred.shape[1:] != dset.shape[1:]:
+                        raise TPDError("_predict_to(): The shapes of the predictions do not match.")
+                    if self.swmr:
+                        dset.resize(start+num_rows, axis=0)
+                    dset[start:start+num_rows] = pred
+                    if self.swmr:
+                        dset.flush()
+                    self._record_io(file_name, bytes_written=pred.nbytes)
+                    start += num_rows
+                if dset is None:
+                    f.create_dataset(h5_key, shape=(0,), dtype=numpy.float64)
+            if pool is not None:
+                pool.close()
+                pool.join()
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        self._set_data(file_name, h5_key, tpd_pred_path, tpd_pred_key, tpd_shape)
+
+    def predict_train_to(self, file_name, h5_key, predict_fn, batch_size, workers=1, dtype=numpy.float64,
+                         compression=None):
+        """
+        Predict the training instances in batches, write the predictions into the
+        given data set and set it as training prediction data.
+
+        :param file_name: output file name
+        :param h5_key: output h5 key
+        :param predict_fn: function that maps a (b, d) feature batch to b predictions (must be picklable if workers > 1)
+        :param batch_size: number of instances per batch
+        :param workers: number of processes that run predict_fn
+        :param dtype: dtype of the features that are passed to predict_fn
+        :param compression: compression of the output data set (e.g. "gzip")
+        """
+        self._predict_to(self._tpd_train_feat, self._tpd_train_shape, self._tpd_train_pred_path,
+                         self._tpd_train_pred_key, file_name, h5_key, predict_fn, batch_size, workers, dtype,
+                         compression)
+
+    def predict_test_to(self, file_name, h5_key, predict_fn, batch_size, workers=1, dtype=numpy.float64,
+                        compression=None):
+        """
+        Predict the test instances in batches, write the predictions into the
+        given data set and set it as test prediction data.
+
+        :param file_name: output file name
+        :param h5_key: output h5 key
+        :param predict_fn: function that maps a (b, d) feature batch to b predictions (must be picklable if workers > 1)
+        :param batch_size: number of instances per batch
+        :param workers: number of processes that run predict_fn
+        :param dtype: dtype of the features that are passed to predict_fn
+        :param compression: compression of the output data set (e.g. "gzip")
+        """
+        self._predict_to(self._tpd_test_feat, self._tpd_test_shape, self._tpd_test_pred_path,
+                         self._tpd_test_pred_key, file_name, h5_key, predict_fn, batch_size, workers, dtype,
+                         compression)
 
     def show(self):
         """Show raw and ground truth data of training and test set.
@@ -518,3 +3046,96 @@ class TrainPredictData(object):
 
         v.show()
         app.exec_()
+
+
+class AsyncTrainPredictData(object):
+    """
+    Asynchronous facade of TrainPredictData for asyncio applications.
+
+    The data getters return awaitables. The blocking reads run on a bounded
+    thread pool, so the event loop is not blocked and the reads of several
+    .tpd files can overlap. Several instances can share one executor.
+    """
+
+    def __init__(self, file_name, max_workers=4, executor=None, loop=None, **kwargs):
+        """Create the facade of the given .tpd file.
+
+        :param file_name: file name
+        :param max_workers: number of threads of the executor (if no executor is given)
+        :param executor: concurrent.futures executor for the blocking reads
+        :param loop: asyncio event loop (default: the current event loop)
+        :param kwargs: further arguments of TrainPredictData
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        self.tpd = TrainPredictData(file_name, **kwargs)
+        self._own_executor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers)
+        self.executor = executor
+        self.loop = loop
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the open data files and shut down the executor (if it was created by this instance).
+        """
+        if self._own_executor:
+            self.executor.shutdown(wait=True)
+        self.tpd.close()
+
+    def _run(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) on the executor.
+
+        :return: asyncio future with the result
+        """
+        import asyncio
+        loop = self.loop
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def get_train_raw_data(self, rows=None, mmap=False):
+        """Return an awaitable with the training raw data (see TrainPredictData.get_train_raw_data).
+        """
+        return self._run(self.tpd.get_train_raw_data, rows, mmap)
+
+    def get_train_gt_data(self, rows=None, mmap=False):
+        """Return an awaitable with the training gt data (see TrainPredictData.get_train_gt_data).
+        """
+        return self._run(self.tpd.get_train_gt_data, rows, mmap)
+
+    def get_train_pred_data(self, rows=None, mmap=False):
+        """Return an awaitable with the training predictions (see TrainPredictData.get_train_pred_data).
+        """
+        return self._run(self.tpd.get_train_pred_data, rows, mmap)
+
+    def get_train_features(self, dtype=numpy.float64, workers=1, cache=False, rows=None, features=None,
+                           mmap=False):
+        """Return an awaitable with the training features (see TrainPredictData.get_train_features).
+        """
+        return self._run(self.tpd.get_train_features, dtype, workers, cache, rows, features, mmap)
+
+    def get_test_raw_data(self, rows=None, mmap=False):
+        """Return an awaitable with the test raw data (see TrainPredictData.get_test_raw_data).
+        """
+        return self._run(self.tpd.get_test_raw_data, rows, mmap)
+
+    def get_test_gt_data(self, rows=None, mmap=False):
+        """Return an awaitable with the test gt data (see TrainPredictData.get_test_gt_data).
+        """
+        return self._run(self.tpd.get_test_gt_data, rows, mmap)
+
+    def get_test_pred_data(self, rows=None, mmap=False):
+        """Return an awaitable with the test predictions (see TrainPredictData.get_test_pred_data).
+        """
+        return self._run(self.tpd.get_test_pred_data, rows, mmap)
+
+    def get_test_features(self, dtype=numpy.float64, workers=1, cache=False, rows=None, features=None,
+                          mmap=False):
+        """Return an awaitable with the test features (see TrainPredictData.get_test_features).
+        """
+        return self._run(self.tpd.get_test_features, dtype, workers, cache, rows, features, mmap)